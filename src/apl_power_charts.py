@@ -7,9 +7,11 @@ Arguments:
 Options:
   -h --help
 """
+import multiprocessing
 from pathlib import Path
 from core.report.report_data import get_report_data, check_report_data
-from report import ISection, build_report, add_test_specs, clean_rsdf, add_apl_power
+from core.report.render import use_figure_cache
+from report import ISection, build_report, add_test_specs, clean_rsdf, add_apl_power, render_apl_power_plots
 
 import core.logfuncs as lf
 import core.filefuncs as ff
@@ -18,11 +20,13 @@ import core.filefuncs as ff
 def make_report(report_data):
     report = ISection(name='report')
     report = add_test_specs(report, **report_data)
-    merged_df = report_data['merged_df']
+    # tests in the order they were run
+    test_names = [test_name for test_name in report_data['merged_df']['test_name'].dropna().unique()
+                  if 'standby' not in test_name]
+    apl_power_plots = render_apl_power_plots(report_data['test_store'], test_names)
     with report.new_section("APL' vs Power Charts", page_break=False) as apl_power:
-        for test_name in merged_df['test_name'].unique():
-            if 'standby' not in test_name:
-                apl_power = add_apl_power(apl_power, test_name, **report_data)
+        for test_name in test_names:
+            apl_power = add_apl_power(apl_power, test_name, plot=apl_power_plots[test_name], **report_data)
     filename = f'apl-power-charts.pdf'
     report_title = "APL' vs Power Charts All Tests"
     build_report(report, filename, report_title=report_title, **report_data)
@@ -31,17 +35,22 @@ def make_report(report_data):
 def main():
     logger, docopt_args, data_folder = lf.start_script(__doc__, 'apl_power_report.log')
     paths = ff.get_paths(data_folder)
-    report_data = get_report_data(paths, data_folder, docopt_args)
-    ISection.save_content_dir = Path(data_folder).joinpath('APLvsPowerCharts')
     expected_data = [
         'data_folder',
         'merged_df',
+        'test_store',
         'rsdf',
-        'test_specs_df'
+        'test_specs_df',
+        'model',
+        'test_date'
     ]
+    report_data = get_report_data(paths, data_folder, docopt_args, expected_data)
+    ISection.save_content_dir = Path(data_folder).joinpath('APLvsPowerCharts')
     check_report_data(report_data, expected_data)
+    use_figure_cache(data_folder)
     make_report(report_data)
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
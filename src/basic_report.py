@@ -7,7 +7,9 @@ Arguments:
 Options:
   -h --help
 """
+import multiprocessing
 from core.report.report_data import get_report_data, check_report_data
+from core.report.render import use_figure_cache
 from report import add_test_results_plots, ISection, build_report, add_test_specs, add_test_results_table
 import core.logfuncs as lf
 import core.filefuncs as ff
@@ -25,16 +27,20 @@ def make_basic_report(report_data):
 def main():
     logger, docopt_args, data_folder = lf.start_script(__doc__, 'basic_report.log')
     paths = ff.get_paths(data_folder)
-    report_data = get_report_data(paths, data_folder, docopt_args)
     expected_data = [
         'data_folder',
-        'merged_df',
+        'test_store',
         'rsdf',
-        'test_specs_df'
+        'test_specs_df',
+        'model',
+        'test_date'
     ]
+    report_data = get_report_data(paths, data_folder, docopt_args, expected_data)
     check_report_data(report_data, expected_data)
+    use_figure_cache(data_folder)
     make_basic_report(report_data)
     
     
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
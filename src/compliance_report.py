@@ -8,6 +8,7 @@ Options:
   -h --help
 """
 from core.report.report_data import get_report_data, check_report_data
+from core.report.render import use_figure_cache
 from report import add_compliance_section, ISection, build_report, add_test_specs
 import core.logfuncs as lf
 import core.filefuncs as ff
@@ -23,21 +24,28 @@ def make_compliance_report(report_data):
 def main():
     logger, docopt_args, data_folder = lf.start_script(__doc__, 'compliance_report.log')
     paths = ff.get_paths(data_folder)
-    report_data = get_report_data(paths, data_folder, docopt_args)
     expected_data = [
         'data_folder',
         'report_type',
-        'merged_df',
+        'omit_estar',
+        'test_store',
         'hdr',
-        'on_mode_df',
-        'limit_funcs',
+        'estar_on_mode_df',
+        'va_on_mode_df',
+        'estar_limit_funcs',
+        'va_limit_funcs',
+        'adjustment_factor',
         'rsdf',
         'area',
         'standby_df',
         'waketimes',
         'test_specs_df',
+        'model',
+        'test_date',
     ]
+    report_data = get_report_data(paths, data_folder, docopt_args, expected_data)
     check_report_data(report_data, expected_data)
+    use_figure_cache(data_folder)
     make_compliance_report(report_data)
     
 
@@ -1,10 +1,41 @@
 from functools import partial, wraps
+from concurrent.futures import Future
+import queue
+import threading
 import PySimpleGUI as sg
 import warnings
 import logging
 
+# calls made from worker threads that have to run on the main thread (Tk isn't thread-safe)
+main_thread_calls = queue.Queue()
+
+def on_main_thread(func, *args):
+    """
+    Call func(*args) on the main thread and return its result. From another thread the call is queued and
+    blocks until the main thread runs it with run_main_thread_calls.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return func(*args)
+    future = Future()
+    main_thread_calls.put((future, func, args))
+    return future.result()
+
+
+def run_main_thread_calls():
+    """Run the calls queued by on_main_thread from worker threads (only call from the main thread)."""
+    while True:
+        try:
+            future, func, args = main_thread_calls.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+
 def error_popup(msg, callback, exception=Exception):
-    p = sg.Popup(msg)
+    p = on_main_thread(sg.Popup, msg)
     if p is None:
         raise exception
     else:
@@ -18,7 +49,7 @@ def permission_popup(func):
             return func(*args, **kwargs)
         except PermissionError as e:
             msg = f'{e}\n\nClose the file referenced above and press OK to continue'
-            error_popup(msg, partial(wrapper, *args, **kwargs), exception=e)
+            return error_popup(msg, partial(wrapper, *args, **kwargs), exception=e)
     return wrapper
 
 
@@ -32,6 +32,13 @@ def send_file(filepath, dst_folder_name, copy=True, date=True):
 
 archive = partial(send_file, dst_folder_name='Archive')
 
+
+def get_cache_dir(data_folder):
+    """Return the folder within data_folder used to keep intermediate results between runs."""
+    cache_dir = Path(data_folder).joinpath('Cache')
+    cache_dir.mkdir(exist_ok=True)
+    return cache_dir
+
 PATTERNS = {
     'test_seq': '*test-sequence*.csv',
     'test_data': '*datalog*.csv',
@@ -0,0 +1,198 @@
+"""Caches of intermediate report results, kept in the data folder's Cache directory."""
+import hashlib
+import json
+import logging
+import os
+import types
+from functools import partial
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+FIGURE_CACHE_BYTES = 200 * 2 ** 20
+
+
+def hash_files(paths, *extra):
+    """Return a sha1 hex digest of the names and contents of the given files (None is skipped) and any extra items."""
+    sha = hashlib.sha1()
+    for path in paths:
+        if path is None:
+            continue
+        sha.update(Path(path).name.encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    for item in extra:
+        sha.update(str(item).encode())
+    return sha.hexdigest()
+
+
+# types of the unique values of columns that NumPy can't store without pickling (see encode_column)
+VALUE_TYPES = {'str': str, 'int': int, 'float': float, 'bool': lambda value: value == 'True'}
+
+
+def encode_column(values):
+    """
+    Return {suffix: array} holding a column in arrays NumPy stores without pickling: numeric, boolean and datetime
+    columns as they are, other columns (strings, mixed objects, extension types) as codes into their unique
+    values, kept as strings along with each value's type. Nulls get code -1.
+    """
+    values = np.asarray(values.astype(object) if isinstance(values, pd.Categorical) else values)
+    if values.dtype != object:
+        return {'': values}
+    codes, uniques = pd.factorize(values)
+    types = ['bool' if isinstance(value, (bool, np.bool_)) else 'int' if isinstance(value, (int, np.integer))
+             else 'float' if isinstance(value, (float, np.floating)) else 'str' for value in uniques]
+    return {'_codes': codes, '_uniques': np.array([str(value) for value in uniques], dtype=str),
+            '_types': np.array(types, dtype=str)}
+
+
+def decode_column(archive, name):
+    """Return the column saved by encode_column under name from an open archive."""
+    if name in archive.files:
+        return archive[name]
+    uniques = [VALUE_TYPES[value_type](value)
+               for value, value_type in zip(archive[f'{name}_uniques'], archive[f'{name}_types'])]
+    codes = archive[f'{name}_codes']
+    values = np.empty(len(uniques) + 1, dtype=object)
+    values[:-1] = uniques
+    values[-1] = np.nan
+    return values[codes]
+
+
+def save_frame(df, path, key, meta=None):
+    """
+    Save a DataFrame as a NumPy archive holding one array per column (see encode_column), tagged with a cache key
+    and optionally a json serializable dictionary of metadata. The archive is replaced in one step, so an
+    interrupted save leaves the old one.
+    """
+    arrays = {}
+    for i, col in enumerate(df.columns):
+        arrays.update({f'column{i}{suffix}': array for suffix, array in encode_column(df[col].values).items()})
+    arrays.update({f'index{suffix}': array for suffix, array in encode_column(df.index.values).items()})
+    tmp_path = Path(f'{path}.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, key=np.array(key), meta=np.array(json.dumps(meta)),
+                 columns=np.array([str(col) for col in df.columns]), **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_frame(path, key=None):
+    """
+    Return the DataFrame saved by save_frame if it exists and was saved with the same key (any key when key is None),
+    otherwise None. Nothing is unpickled, the cache folder is writable by anyone using the data folder.
+    """
+    try:
+        with np.load(path, allow_pickle=False) as archive:
+            if key is not None and str(archive['key']) != key:
+                return None
+            columns = list(archive['columns'])
+            data = {col: decode_column(archive, f'column{i}') for i, col in enumerate(columns)}
+            return pd.DataFrame(data, columns=columns, index=decode_column(archive, 'index'))
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def load_meta(path):
+    """Return the metadata saved by save_frame (None if there is no archive or it has no metadata)."""
+    try:
+        with np.load(path) as archive:
+            return json.loads(str(archive['meta']))
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def cell_contents(cell):
+    try:
+        return cell.cell_contents
+    except ValueError:
+        # the variable isn't assigned yet
+        return None
+
+
+def update_hash(sha, obj):
+    """Feed the contents of obj (frames, arrays, containers, functions and plain values) into a hashlib object."""
+    if isinstance(obj, pd.DataFrame):
+        sha.update(f'{list(obj.columns)}{list(obj.dtypes)}'.encode())
+        sha.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, pd.Series):
+        sha.update(f'{obj.name}{obj.dtype}'.encode())
+        sha.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, np.ndarray):
+        sha.update(f'{obj.dtype}{obj.shape}'.encode())
+        sha.update(obj.tobytes() if obj.dtype != object else str(obj.tolist()).encode())
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            update_hash(sha, key)
+            update_hash(sha, value)
+    elif isinstance(obj, (list, tuple)):
+        sha.update(f'{type(obj).__name__}{len(obj)}'.encode())
+        for item in obj:
+            update_hash(sha, item)
+    elif isinstance(obj, partial):
+        update_hash(sha, (obj.func, obj.args, obj.keywords))
+    elif isinstance(obj, types.CodeType):
+        # the bytecode, constants (including nested functions' code) and names used
+        sha.update(obj.co_code)
+        update_hash(sha, obj.co_consts)
+        update_hash(sha, obj.co_names)
+    elif isinstance(obj, types.FunctionType):
+        # closures such as the limit functions of get_limit_funcs differ only by the values they capture
+        sha.update(f'{obj.__module__}.{obj.__qualname__}'.encode())
+        update_hash(sha, obj.__code__)
+        update_hash(sha, obj.__defaults__)
+        update_hash(sha, obj.__kwdefaults__)
+        update_hash(sha, [cell_contents(cell) for cell in obj.__closure__ or () if cell_contents(cell) is not obj])
+    elif callable(obj) and hasattr(obj, '__qualname__'):
+        sha.update(f'{obj.__module__}.{obj.__qualname__}'.encode())
+    elif hasattr(obj, '__dict__'):
+        # e.g. TestDataStore, hashed by its attributes
+        sha.update(type(obj).__name__.encode())
+        update_hash(sha, vars(obj))
+    else:
+        sha.update(repr(obj).encode())
+
+
+def hash_objects(*objs):
+    """Return a sha1 hex digest of the contents of the given objects (see update_hash)."""
+    sha = hashlib.sha1()
+    for obj in objs:
+        update_hash(sha, obj)
+    return sha.hexdigest()
+
+
+class FigureCache:
+    """
+    Rendered figures stored as PNG files named by cache key, evicted least recently used first once the
+    folder grows past max_bytes. Reading a figure refreshes its modification time.
+    """
+
+    def __init__(self, folder, max_bytes=FIGURE_CACHE_BYTES):
+        self.folder = Path(folder)
+        self.folder.mkdir(exist_ok=True, parents=True)
+        self.max_bytes = max_bytes
+
+    def get(self, key):
+        """Return the PNG bytes stored under key, or None."""
+        path = self.folder.joinpath(f'{key}.png')
+        try:
+            png = path.read_bytes()
+            os.utime(path)
+            return png
+        except OSError:
+            return None
+
+    def put(self, key, png):
+        """Store PNG bytes under key, then evict the least recently used figures beyond max_bytes."""
+        try:
+            self.folder.joinpath(f'{key}.png').write_bytes(png)
+        except OSError as e:
+            logging.warning(f'figure not cached: {e}')
+            return
+        files = sorted(self.folder.glob('*.png'), key=lambda path: path.stat().st_mtime, reverse=True)
+        total = 0
+        for path in files:
+            total += path.stat().st_size
+            if total > self.max_bytes:
+                path.unlink()
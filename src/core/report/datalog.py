@@ -0,0 +1,382 @@
+"""
+Incremental datalog ingestion.
+
+The datalog is only ever appended to while a test sequence runs. Datalog rows reduced by merge.DatalogReducer are
+appended to a file of fixed width binary records in the data folder's cache (RECORDS_NAME). A checkpoint
+(STORE_NAME) holds the byte offset and a hash of the last datalog line already read, the reducer state and a table
+with the record range of every test, so a merge only reads the datalog rows written since the checkpoint and only
+merges the tests they belong to. The merged rows of every test are kept in an archive of their own (BLOCKS_NAME)
+and merged.csv is only rewritten from the first changed test onwards (see write_merged_csv).
+
+Rewinds, tags shared by several runs and timestamps going backwards break the bookkeeping per test. The records
+are then reduced and merged as a whole again, which still doesn't read the datalog again.
+"""
+import hashlib
+import io
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from . import merge, cache
+from .store import row_ranges
+from ..filefuncs import get_cache_dir
+
+STORE_NAME = 'merge-store.npz'
+RECORDS_NAME = 'merge-store.bin'
+BLOCKS_NAME = 'merged-tests'
+# bump when the store layout or the datalog reduction changes so that old stores get rebuilt
+STORE_VERSION = 3
+RECORD_DTYPE = np.dtype([('time', 'M8[ns]'), ('Power', 'f8'), ('Luminance', 'f8'), ('Tag', 'f8'), ('run', 'i8')])
+# one row per test (tag) in order of first appearance: its run and record range, the times of its first record and
+# of the record before it (the first record is dropped as a duplicate when they are equal), its number of reduced
+# rows and of merged rows
+TABLE_COLS = ['tag', 'run', 'start', 'stop', 'first_time', 'prev_time', 'rows', 'merged']
+
+
+class ByteRange(io.RawIOBase):
+    """Raw stream over an open binary file which ends at the given byte offset."""
+
+    def __init__(self, f, end):
+        self.f = f
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), self.end - self.f.tell())
+        if size <= 0:
+            return 0
+        data = self.f.read(size)
+        b[:len(data)] = data
+        return len(data)
+
+
+def line_end_before(f, start, stop):
+    """Return the offset just past the last newline in f[start:stop] (start if there is none)."""
+    block = 1 << 16
+    pos = stop
+    while pos > start:
+        read_start = max(start, pos - block)
+        f.seek(read_start)
+        newline = f.read(pos - read_start).rfind(b'\n')
+        if newline >= 0:
+            return read_start + newline + 1
+        pos = read_start
+    return start
+
+
+def read_bytes(f, start, end):
+    f.seek(start)
+    return f.read(end - start)
+
+
+def read_columns(datalog_path):
+    """Return the column names of a datalog csv (parsed like the rest of the file, a byte order mark is dropped)."""
+    return list(pd.read_csv(datalog_path, nrows=0, encoding='utf-8-sig').columns)
+
+
+def last_line_hash(f, header_end, offset):
+    """Hash of the datalog line ending at offset (which identifies the datalog read up to there)."""
+    line = read_bytes(f, line_end_before(f, header_end, offset - 1), offset) if offset > header_end else b''
+    return hashlib.sha1(line).hexdigest()
+
+
+def store_paths(data_folder):
+    cache_dir = get_cache_dir(data_folder)
+    return cache_dir.joinpath(STORE_NAME), cache_dir.joinpath(RECORDS_NAME), cache_dir.joinpath(BLOCKS_NAME)
+
+
+def load_checkpoint(data_folder):
+    """Return the checkpoint and test table of the last incremental merge, or (None, None)."""
+    store_path = store_paths(data_folder)[0]
+    checkpoint = cache.load_meta(store_path)
+    if checkpoint is None or checkpoint.get('version') != STORE_VERSION:
+        return None, None
+    return checkpoint, cache.load_frame(store_path)
+
+
+def owns_merged_csv(data_folder, merged_path):
+    """Whether merged_path is the merged.csv written by the last incremental merge (and not changed since)."""
+    checkpoint = load_checkpoint(data_folder)[0]
+    return checkpoint is not None and csv_layout_matches(merged_path, checkpoint['csv'])
+
+
+def to_records(df):
+    """Reducer pieces (time, Power, Luminance, Tag and run columns) as an array of RECORD_DTYPE records."""
+    records = np.empty(len(df), dtype=RECORD_DTYPE)
+    for name in RECORD_DTYPE.names:
+        records[name] = df[name].values
+    return records
+
+
+def read_records(path, start=0, stop=None):
+    """Return records [start, stop) of the records file as a DataFrame."""
+    if stop is not None and stop <= start:
+        records = np.empty(0, dtype=RECORD_DTYPE)
+    else:
+        count = -1 if stop is None else stop - start
+        records = np.fromfile(path, dtype=RECORD_DTYPE, count=count, offset=start * RECORD_DTYPE.itemsize)
+    return pd.DataFrame({name: records[name] for name in RECORD_DTYPE.names})
+
+
+def append_records(path, df, start):
+    """Write the records of df after the first start records of the records file (dropping anything after them)."""
+    with open(path, 'r+b' if start else 'wb') as f:
+        f.seek(start * RECORD_DTYPE.itemsize)
+        f.truncate()
+        f.write(to_records(df).tobytes())
+
+
+def build_table(records, run_tags):
+    """
+    Return the test table of all records (see TABLE_COLS) and whether merges can go on test by test: times never
+    go backwards and every tag has a single run after rewound runs are discarded.
+    """
+    last_runs = {tag: run for run, tag in run_tags.items()}
+    kept_runs = sorted(set(last_runs.values()))
+    runs = records['run'].values
+    times = records['time'].values
+    kept = ~np.isin(runs, [run for run in run_tags if last_runs[run_tags[run]] != run])
+    # position of the last record of a kept run at or before each record
+    last_kept = np.maximum.accumulate(np.where(kept, np.arange(len(runs)), -1))
+
+    rows = []
+    for run in kept_runs:
+        start, stop = np.searchsorted(runs, run), np.searchsorted(runs, run, side='right')
+        if start == stop or np.isnan(records['Tag'].values[start]):
+            continue
+        prev = last_kept[start - 1] if start else -1
+        prev_time = times[prev] if prev >= 0 else np.datetime64('NaT')
+        rows.append([records['Tag'].values[start], run, start, stop, times[start], prev_time,
+                     stop - start - int(times[start] == prev_time), 0])
+    table = pd.DataFrame(rows, columns=TABLE_COLS)
+    appendable = bool((np.diff(times) >= np.timedelta64(0)).all()) and not table['tag'].duplicated().any()
+    return table, appendable
+
+
+def extend_table(table, new_records, start, last_time):
+    """
+    Add new records (stored from position start on, after a record at last_time) to the test table.
+    Returns the table and its tags that got records, or None if a new run repeats an earlier tag or times go
+    backwards, which the table can't follow.
+    """
+    times = new_records['time'].values
+    if (np.diff(times) < np.timedelta64(0)).any() or (len(times) and last_time is not None and times[0] < last_time):
+        return None
+    table = table.reset_index(drop=True)
+    touched = []
+    tags = new_records['Tag'].values
+    for run, (run_start, run_stop) in row_ranges(new_records['run'].values).items():
+        if np.isnan(tags[run_start]):
+            continue
+        continued = table['run'] == run
+        if continued.any():
+            table.loc[continued, 'stop'] = start + run_stop
+        elif tags[run_start] in set(table['tag']):
+            return None
+        else:
+            prev_time = times[run_start - 1] if run_start else last_time
+            table.loc[len(table)] = [tags[run_start], run, start + run_start, start + run_stop, times[run_start],
+                                     np.datetime64('NaT') if prev_time is None else prev_time, 0, 0]
+        touched.append(tags[run_start])
+    table['rows'] = table['stop'] - table['start'] - (table['first_time'] == table['prev_time']).astype(int)
+    return table, touched
+
+
+def tag_rows(records_path, table, tags):
+    """Return the reduced datalog rows (time, Power, Luminance, Tag) of the given tags, read from the records file."""
+    pieces = []
+    for row in table[table['tag'].isin(tags)].itertuples():
+        piece = read_records(records_path, row.start, row.stop)
+        pieces.append(piece.iloc[int(row.first_time == row.prev_time):])
+    return pd.concat(pieces, ignore_index=True)[['time', 'Power', 'Luminance', 'Tag']] if pieces else \
+        read_records(records_path, 0, 0)[['time', 'Power', 'Luminance', 'Tag']]
+
+
+def block_path(blocks_dir, tag):
+    return blocks_dir.joinpath(f'{float(tag)}.npz')
+
+
+def save_blocks(merged_df, table, tags, blocks_dir, base_key):
+    """Save the merged rows of the given tags (grouped by tag in merged_df) and record their number in table."""
+    ranges = row_ranges(merged_df['tag'].values)
+    blocks_dir.mkdir(exist_ok=True)
+    for i, tag in zip(table.index, table['tag']):
+        if tag in tags:
+            start, stop = ranges.get(tag, (0, 0))
+            table.loc[i, 'merged'] = stop - start
+            if stop > start:
+                cache.save_frame(merged_df.iloc[start:stop], block_path(blocks_dir, tag), base_key)
+            else:
+                block_path(blocks_dir, tag).unlink(missing_ok=True)
+
+
+def is_rewound(old_run_tags, run_tags):
+    """Whether a run started since old_run_tags repeats the raw tag of any earlier run (a rewound test)."""
+    seen = set(old_run_tags.values())
+    for run, tag in run_tags.items():
+        if run not in old_run_tags:
+            if tag in seen:
+                return True
+            seen.add(tag)
+    return False
+
+
+def merge_appended(test_seq_df, table, touched, checkpoint, base_key, records_path, blocks_dir, old_tag_counts,
+                   tag_counts):
+    """
+    Merge the tests with new records or a changed wake time again and reuse the saved merged rows of the others.
+    Returns merged_df and the tags that were merged again.
+    """
+    test_seq_df = merge.add_stab_test_rows(test_seq_df, table.set_index('tag')['rows'][lambda rows: rows > 0])
+    # standby tests hold the wake time counted from the user commands of the waketime test after them
+    old_waketimes = merge.get_waketimes(test_seq_df, old_tag_counts)
+    waketime_tests = [test_name for test_name, waketime in merge.get_waketimes(test_seq_df, tag_counts).items()
+                      if old_waketimes.get(test_name) != waketime]
+    changed = set(touched) | set(test_seq_df.loc[test_seq_df['test_name'].isin(waketime_tests), 'tag'])
+    if checkpoint['base'] != base_key:
+        changed = set(table['tag'])
+
+    blocks = {}
+    for tag, merged in zip(table['tag'], table['merged']):
+        if tag not in changed and merged:
+            blocks[tag] = cache.load_frame(block_path(blocks_dir, tag), base_key)
+            if blocks[tag] is None:
+                changed.add(tag)
+    changed_df = merge.merge_tests(test_seq_df, tag_rows(records_path, table, changed))
+    changed_df = merge.add_waketimes(changed_df, test_seq_df, tag_counts)
+    save_blocks(changed_df, table, changed, blocks_dir, base_key)
+    ranges = row_ranges(changed_df['tag'].values)
+    blocks.update({tag: changed_df.iloc[start:stop] for tag, (start, stop) in ranges.items()})
+
+    merged_blocks = [blocks[tag] for tag in table['tag'] if blocks.get(tag) is not None]
+    merged_df = pd.concat(merged_blocks, ignore_index=True) if merged_blocks else changed_df
+    return merged_df, changed
+
+
+def merge_datalog_incremental(test_seq_df, datalog_path, data_folder, base_key, merged_path,
+                              chunksize=merge.DATALOG_CHUNKSIZE):
+    """
+    Merge the datalog with the test sequence like merge.merge_reduced_data (with a source column), write merged.csv
+    to merged_path and return merged_df, while only reading datalog rows appended since the last merge and only
+    merging the tests those rows (or changed wake times) belong to. base_key identifies the test sequence and APL
+    data; when it changes every test is merged again from the stored records.
+    """
+    store_path, records_path, blocks_dir = store_paths(data_folder)
+    columns = read_columns(datalog_path)
+    source = Path(datalog_path).name
+    datalog_key = cache.hash_objects(source, columns)
+    checkpoint, table = load_checkpoint(data_folder)
+    reducer = merge.DatalogReducer()
+
+    with open(datalog_path, 'rb') as f:
+        f.readline()
+        header_end = f.tell()
+        # a partially written last line is left for the next merge
+        end = line_end_before(f, header_end, f.seek(0, io.SEEK_END))
+        if checkpoint is not None and table is not None and checkpoint['datalog'] == datalog_key and \
+                header_end <= checkpoint['offset'] <= end and \
+                last_line_hash(f, header_end, checkpoint['offset']) == checkpoint['last_line'] and \
+                records_path.exists() and records_path.stat().st_size >= checkpoint['records'] * RECORD_DTYPE.itemsize:
+            start, stored = checkpoint['offset'], checkpoint['records']
+            reducer.set_state(checkpoint['state'])
+        else:
+            start, stored, checkpoint = header_end, 0, None
+
+        old_run_tags, old_tag_counts = dict(reducer.run_tags), dict(reducer.tag_counts)
+        last_time = None if reducer.last_time is None else reducer.last_time.to_datetime64()
+        if start < end:
+            f.seek(start)
+            chunks = pd.read_csv(io.BufferedReader(ByteRange(f, end)), header=None, names=columns,
+                                 usecols=merge.DATALOG_COLS, dtype={'Tag': str}, parse_dates=['Timestamp'],
+                                 chunksize=chunksize)
+            for chunk in chunks:
+                reducer.feed(chunk)
+        last_line = last_line_hash(f, header_end, end)
+
+    new_records = pd.concat(reducer.pieces, ignore_index=True) if reducer.pieces else read_records(records_path, 0, 0)
+    append_records(records_path, new_records, stored)
+
+    extended = None
+    if checkpoint is not None and checkpoint['appendable'] and not is_rewound(old_run_tags, reducer.run_tags):
+        extended = extend_table(table, new_records, stored, last_time)
+    if extended is not None:
+        table, touched = extended
+        appendable = True
+        merged_df, changed = merge_appended(test_seq_df, table, touched, checkpoint, base_key, records_path,
+                                            blocks_dir, old_tag_counts, reducer.tag_counts)
+    else:
+        # rewinds, repeated tags and times going backwards: merge all tests again from the stored records
+        reducer.pieces = [read_records(records_path)]
+        table, appendable = build_table(reducer.pieces[0], reducer.run_tags)
+        merged_df = merge.merge_reduced_data(test_seq_df, reducer.result(), reducer.tag_counts).reset_index(drop=True)
+        changed = set(table['tag'])
+        shutil.rmtree(blocks_dir, ignore_errors=True)
+        if appendable:
+            save_blocks(merged_df, table, changed, blocks_dir, base_key)
+    merged_df['source'] = source
+
+    layout = write_merged_csv(merged_df, merged_path, set(table['tag']) - changed,
+                              checkpoint['csv'] if checkpoint is not None else None)
+    cache.save_frame(table, store_path, None, meta={
+        'version': STORE_VERSION,
+        'datalog': datalog_key,
+        'offset': end,
+        'last_line': last_line,
+        'records': stored + len(new_records),
+        'state': reducer.get_state(),
+        'appendable': appendable,
+        'base': base_key,
+        'csv': layout,
+    })
+    return merged_df
+
+
+def csv_layout_matches(path, layout):
+    """Whether the file at path is still the one described by a write_merged_csv layout."""
+    if path is None or layout is None or not Path(path).exists():
+        return False
+    stat = Path(path).stat()
+    return [stat.st_size, stat.st_mtime_ns] == [layout['size'], layout['mtime_ns']]
+
+
+def write_merged_csv(merged_df, path, kept=(), layout=None):
+    """
+    Write merged_df (rows grouped by tag) to path one test at a time. When layout (returned by the previous write)
+    still describes the file, the leading tests that are in kept and in the same order as before are left as they
+    are and only the rest of the file is rewritten. Returns the layout of the written file.
+    """
+    path = Path(path)
+    header = merged_df.iloc[:0].to_csv(index=False)
+    ranges = row_ranges(merged_df['tag'].values)
+    blocks = []
+    if ranges is None or sum(stop - start for start, stop in ranges.values()) != len(merged_df):
+        # rows not grouped by tag are written in one go
+        merged_df.to_csv(path, index=False)
+        stat = path.stat()
+        return {'header': header, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'blocks': blocks}
+
+    tags = list(ranges)
+    if csv_layout_matches(path, layout) and layout['header'] == header:
+        for tag, block in zip(tags, layout['blocks']):
+            if block[0] != tag or tag not in kept:
+                break
+            blocks.append(block)
+        if len(blocks) == len(tags) == len(layout['blocks']):
+            return layout
+
+    with open(path, 'r+b' if blocks else 'wb') as f:
+        if blocks:
+            f.seek(blocks[-1][2])
+            f.truncate()
+        else:
+            f.write(header.encode())
+        for tag in tags[len(blocks):]:
+            start, stop = ranges[tag]
+            block_start = f.tell()
+            f.write(merged_df.iloc[start:stop].to_csv(header=False, index=False).encode())
+            blocks.append([tag, block_start, f.tell()])
+
+    stat = path.stat()
+    return {'header': header, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'blocks': blocks}
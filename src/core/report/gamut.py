@@ -0,0 +1,69 @@
+"""Chromaticity triangle geometry for gamut coverage."""
+import numpy as np
+
+# measured primaries spanning less than this share of the colorspace triangle's area are degenerate
+DEGENERATE_AREA = 1e-9
+
+
+def polygon_area(points):
+    """Area of a polygon given as an (n, 2) array of vertices (shoelace formula)."""
+    x, y = np.asarray(points, dtype=float).T
+    return abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+
+def clip_polygon(subject, clip):
+    """Intersection of a polygon with a convex clip polygon (Sutherland-Hodgman), as an (n, 2) array of vertices."""
+    clip = np.asarray(clip, dtype=float)
+    # orient clip counterclockwise so that inside is to the left of every edge
+    x, y = clip.T
+    if np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)) < 0:
+        clip = clip[::-1]
+
+    def side(a, b, p):
+        return (b[0] - a[0]) * (p[1] - a[1]) - (b[1] - a[1]) * (p[0] - a[0])
+
+    output = [np.asarray(point, dtype=float) for point in subject]
+    for a, b in zip(clip, np.roll(clip, -1, axis=0)):
+        points, output = output, []
+        for p, q in zip(points, points[1:] + points[:1]):
+            p_side, q_side = side(a, b, p), side(a, b, q)
+            if p_side >= 0:
+                output.append(p)
+            if (p_side >= 0) != (q_side >= 0):
+                output.append(p + (q - p) * p_side / (p_side - q_side))
+    return np.array(output).reshape(-1, 2)
+
+
+def sample_coverage(primaries, colorspace_primaries, samples, seed=0):
+    """Monte Carlo estimate of triangle_coverage: share of random points in the colorspace triangle inside primaries."""
+    rng = np.random.RandomState(seed)
+    s, t = np.sort(rng.random_sample((2, samples)), axis=0)
+    pt1, pt2, pt3 = np.asarray(colorspace_primaries, dtype=float)
+    points = np.outer(s, pt1) + np.outer(t - s, pt2) + np.outer(1 - t, pt3)
+
+    # a point is inside a triangle when it is on the same side of all three edges
+    sides = []
+    for a, b in zip(primaries, np.roll(primaries, -1, axis=0)):
+        sides.append((b[0] - a[0]) * (points[:, 1] - a[1]) - (b[1] - a[1]) * (points[:, 0] - a[0]))
+    sides = np.array(sides)
+    inside = (sides >= 0).all(axis=0) | (sides <= 0).all(axis=0)
+    return inside.mean()
+
+
+def triangle_coverage(primaries, colorspace_primaries, samples=None):
+    """
+    Share of the colorspace triangle covered by the triangle of measured primaries, from the area of the
+    triangles' intersection or by sampling when samples is given. Degenerate primaries (identical or collinear
+    points) cover nothing.
+    """
+    primaries = np.asarray(primaries, dtype=float)
+    colorspace_primaries = np.asarray(colorspace_primaries, dtype=float)
+    colorspace_area = polygon_area(colorspace_primaries)
+    if polygon_area(primaries) <= DEGENERATE_AREA * colorspace_area:
+        return 0.0
+    if samples:
+        return sample_coverage(primaries, colorspace_primaries, samples)
+    intersection = clip_polygon(colorspace_primaries, primaries)
+    if len(intersection) < 3:
+        return 0.0
+    return polygon_area(intersection) / colorspace_area
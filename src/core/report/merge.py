@@ -1,4 +1,5 @@
-import datetime
+import functools
+import logging
 import sys
 from pathlib import Path
 import numpy as np
@@ -9,21 +10,20 @@ APL_FILES = {
     'sdr': r'config\apl\sdr-APL.csv',
     'clasp_hdr': r'config\apl\clasp_hdr10-APL.csv',
 }
+# APL tables compiled to per clip arrays (see load_apl_tables)
+APL_CACHE = r'config\apl\apl-tables.npz'
+APL_COLS = ["APL'", 'R', 'G', 'B']
+# merged_df columns converted by compact_merged_df
+COMPACT_CATEGORY_COLS = ['test_name', 'video', 'preset_picture', 'abc', 'lux', 'qs', 'lan', 'wan', 'special_commands',
+                         'source']
+COMPACT_FLOAT_COLS = ['watts', 'nits', "APL'", 'R', 'G', 'B']
+# datalog columns used by the merge and the number of datalog rows read at once when streaming
+DATALOG_COLS = ['Timestamp', 'Power', 'Luminance', 'Tag']
+DATALOG_CHUNKSIZE = 50000
 
-def round_time(dt=None, date_delta=datetime.timedelta(seconds=1)):
-    """Round a datetime object to a multiple of a timedelta
-    dt : datetime.datetime object, default now.
-    date_delta : timedelta object, we round to a multiple of this, default 1 minute.
-    Author: Thierry Husson 2012 - Use it as you want but don't blame me.
-            Stijn Nevens 2014 - Changed to use only datetime objects as variables
-    """
-    roundTo = date_delta.total_seconds()
-
-    if dt == None: dt = datetime.datetime.now()
-    seconds = (dt.to_pydatetime() - dt.min).seconds
-    # // is a floor division, not a comment on following line:
-    rounding = (seconds + roundTo / 2) // roundTo * roundTo
-    return dt + datetime.timedelta(0, rounding - seconds, -dt.microsecond)
+def quantize_time(timestamps):
+    """Quantize a datetime64 Series of datalog timestamps to whole seconds by dropping the sub-second part."""
+    return timestamps.dt.floor('s')
 
 
 def clean_tag(tag):
@@ -39,12 +39,20 @@ def clean_tag(tag):
 
 def add_stab_tests(test_seq_df, df):
     """Add a row to test_seq_df for each stabilization test in data_df"""
+    return add_stab_test_rows(test_seq_df, df.groupby('Tag', sort=False).size())
+
+
+def add_stab_test_rows(test_seq_df, tag_sizes):
+    """
+    Add a row to test_seq_df for each stabilization test in tag_sizes, the number of reduced datalog rows of
+    every tag in order of first appearance.
+    """
     stab_row = test_seq_df[test_seq_df['test_name'] == 'stabilization'].iloc[0]
-    stab_tags = df[(df['Tag'] > stab_row['tag']) & (df['Tag'] < stab_row['tag']+1)]['Tag'].unique()
+    stab_tags = [tag for tag in tag_sizes.index if stab_row['tag'] < tag < stab_row['tag'] + 1]
     df_list = []
     for i, tag in enumerate(stab_tags):
         new_row = stab_row.copy().to_frame().T
-        new_row['test_time'] = len(df[df['Tag'] == tag])
+        new_row['test_time'] = int(tag_sizes[tag])
         new_row['tag'] = tag
         new_row['test_name'] = f'stabilization{i+1}'
         df_list.append(new_row)
@@ -57,85 +65,268 @@ def add_stab_tests(test_seq_df, df):
 
 def cut_off_intros(df):
     """Discards test set up and video countdown data at beginning of tests"""
-    sdf = df.groupby(['tag']).first().loc[df['tag'].unique()].reset_index()
-    sdf = sdf.dropna(subset=['test_time'])
-    df_list = []
-    for _, row in sdf.iterrows():
-        # Isolate the test data for just this test
-        tag = row['tag']
-        single_test_df = df[df['tag'] == tag].copy()
-        t = int(row['test_time'])
-        end_time = max(single_test_df['time'])
-        start_time = end_time - pd.Timedelta(seconds=t)
-        single_test_df = single_test_df[single_test_df['time'] > start_time]
-        single_test_df['seconds'] = range(len(single_test_df))
-        df_list.append(single_test_df)
+    by_tag = df.groupby('tag')
+    test_time = pd.to_numeric(by_tag['test_time'].transform('first'))
+    end_time = by_tag['time'].transform('max')
+    # keep the last test_time seconds of each test (tests without a test_time are dropped)
+    keep = test_time.notna() & (df['time'] > end_time - pd.to_timedelta(np.trunc(test_time), unit='s'))
+    # tests are output in order of first appearance
+    order = np.argsort(pd.factorize(df['tag'])[0][keep.values], kind='mergesort')
+    df = df[keep].iloc[order].copy()
+    df['seconds'] = df.groupby('tag').cumcount()
+    return df
+
+
+def compile_apl_tables():
+    """Read the APL csvs into one array per clip, where row i holds the APL_COLS values at second i."""
+    tables = {}
+    for clip_name, file in APL_FILES.items():
+        apl_df = pd.read_csv(Path(sys.path[0]).joinpath(file))
+        seconds = apl_df['seconds'].values.astype(int)
+        table = np.full((seconds.max() + 1, len(APL_COLS)), np.nan)
+        table[seconds] = apl_df[APL_COLS].values
+        tables[clip_name] = table
+    return tables
 
-    return pd.concat(df_list)
+
+@functools.lru_cache()
+def load_apl_tables():
+    """
+    Load the compiled APL tables, recompiling them when APL_FILES changed or a csv is newer than APL_CACHE.
+    Tables are held for the rest of the process.
+    """
+    cache_path = Path(sys.path[0]).joinpath(APL_CACHE)
+    files = '|'.join(f'{clip_name}={file}' for clip_name, file in APL_FILES.items())
+    csv_mtime = max(Path(sys.path[0]).joinpath(file).stat().st_mtime for file in APL_FILES.values())
+    if cache_path.exists() and cache_path.stat().st_mtime >= csv_mtime:
+        with np.load(cache_path) as archive:
+            if str(archive['files']) == files:
+                return {clip_name: archive[clip_name] for clip_name in APL_FILES}
+
+    tables = compile_apl_tables()
+    try:
+        np.savez(cache_path, files=files, **tables)
+    except OSError:
+        logging.warning(f'Could not write APL cache: {cache_path}')
+    return tables
 
 
 def add_apl_data(df):
-    """Merge APL data to main df."""
-    apl_dfs = {clip_name: pd.read_csv(Path(sys.path[0]).joinpath(file)) for clip_name, file in APL_FILES.items()}
-    df_list = []
-    for clip_name, apl_df in apl_dfs.items():
-        apl_df['video'] = clip_name
-        df_list.append(apl_df)
+    """Add APL data to main df by looking up each row's video and seconds in the APL tables."""
+    seconds = df['seconds'].values.astype(int)
+    video = df['video'].values
+    values = np.full((len(df), len(APL_COLS)), np.nan)
+    for clip_name, table in load_apl_tables().items():
+        rows = (video == clip_name) & (seconds < len(table))
+        values[rows] = table[seconds[rows]]
 
-    all_apl_df = pd.concat(df_list)
-    df = df.merge(all_apl_df, on=['video', 'seconds'], how='left')
+    df = df.reset_index(drop=True)
+    for i, col in enumerate(APL_COLS):
+        df[col] = values[:, i]
     df["APL'"] = df["APL'"].fillna(0)
     return df
 
 
-def remove_rows_rewind(df, col='Tag'):
+def run_lengths(series):
+    """Run-length encode a Series and return the start position, length and value of each run (nulls are runs of one)."""
+    starts = np.flatnonzero((series != series.shift()).values)
+    lengths = np.diff(np.append(starts, len(series)))
+    return starts, lengths, series.values[starts]
 
-    start_tag_seq_df = df[df[col]!=df[col].shift(1)].dropna(subset=[col])
-    duplicate_start = start_tag_seq_df[start_tag_seq_df[col].duplicated(keep='last')].index.values
 
-    end_tag_seq_df = df[df[col]!=df[col].shift(-1)].dropna(subset=[col])
-    duplicate_end = end_tag_seq_df[end_tag_seq_df[col].duplicated(keep='last')].index.values + 1
+def log_rewinds(col, runs, seconds):
+    """Log how much data was discarded because tests were rewound."""
+    logging.info(f'Rewound tests: discarded {runs} earlier {col} runs ({seconds} seconds of data)')
 
-    remove_rows = []
-    for start, end in zip(duplicate_start, duplicate_end):
-        remove_rows += range(start, end)
-    return df.drop(remove_rows)
+
+def remove_rows_rewind(df, col='Tag'):
+    """Keep only the last run of each repeated col value (earlier runs were rewound and rerun)."""
+    starts, lengths, values = run_lengths(df[col])
+    run_values = pd.Series(values)
+    discarded = (run_values.notna() & run_values.duplicated(keep='last')).values
+    log_rewinds(col, discarded.sum(), lengths[discarded].sum())
+    return df[np.repeat(~discarded, lengths)]
 
 
-def add_waketimes(merged_df, test_seq_df, data_df):
-    """Calculate wake times from the test data and return as a dictionary."""
+def get_waketimes(test_seq_df, tag_counts):
+    """Return {standby test_name: wake time} from the raw datalog tag counts of the waketime tests' user commands."""
     waketimes = {}
     for _, row in test_seq_df.iterrows():
         if 'waketime' in row['test_name']:
             standby_tag = row['tag'] - 1
             standby_test = test_seq_df.query('tag==@standby_tag')['test_name'].iloc[0]
             wt_tag = f"{row['tag'] + .1} - user command"
-            waketime = len(data_df.query('Tag==@wt_tag'))
+            waketime = tag_counts.get(wt_tag, 0)
             waketimes[standby_test] = waketime
-            
-    merged_df['waketime'] = merged_df['test_name'].apply(waketimes.get)
+    return waketimes
+
+
+def add_waketimes(merged_df, test_seq_df, tag_counts):
+    """Calculate wake times from the raw datalog tag counts and add them to merged_df."""
+    waketimes = get_waketimes(test_seq_df, tag_counts)
+    # always float, so the column doesn't depend on whether merged_df holds tests without a wake time
+    merged_df['waketime'] = merged_df['test_name'].map(waketimes).astype(float)
     return merged_df
 
 
+def compact_merged_df(df):
+    """Store repeated string columns of merged_df as categoricals and measurement columns as float32."""
+    df = df.copy()
+    for col in COMPACT_CATEGORY_COLS:
+        if col in df.columns and (pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col])):
+            df[col] = df[col].astype('category')
+    for col in COMPACT_FLOAT_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype(np.float32)
+    return df
+
+
+def log_memory(df, stage):
+    """Log the memory used by a DataFrame at a processing stage."""
+    mb = df.memory_usage(index=True, deep=True).sum() / 2**20
+    logging.info(f'{stage}: {len(df)} rows, {mb:.1f} MB')
+
+
+class DatalogReducer:
+    """
+    Reduces raw datalog rows to one row per second, one chunk at a time.
+
+    Rewound tag runs, the open tag run and the last timestamp are tracked across chunks,
+    so feeding a datalog in pieces of any size gives the same rows as remove_rows_rewind,
+    quantize_time and drop_duplicates applied to the whole file at once.
+    """
+
+    def __init__(self):
+        self.run = 0
+        self.last_tag = None
+        self.last_time = None
+        # tag of every (non-null) tag run, keyed by run number
+        self.run_tags = {}
+        # number of raw datalog rows per tag (used for waketimes)
+        self.tag_counts = {}
+        self.pieces = []
+
+    def feed(self, chunk):
+        """Reduce a chunk of raw datalog rows (Timestamp, Power, Luminance and Tag columns) and return the kept rows."""
+        if chunk.empty:
+            return None
+        # tags repeat heavily: parse each distinct tag once and work with integer tag codes per row
+        raw_codes, raw_tags = pd.factorize(chunk['Tag'])
+        counts = np.bincount(raw_codes[raw_codes >= 0], minlength=len(raw_tags))
+        for tag, count in zip(raw_tags, counts):
+            self.tag_counts[tag] = self.tag_counts.get(tag, 0) + int(count)
+
+        # camera ccf tags become their tag number, so several raw tags can share a code
+        tag_codes, tags = pd.factorize(
+            np.array([tag[0] if 'camera ccf' in str(tag) else tag for tag in raw_tags], dtype=object))
+        codes = np.append(tag_codes, -1)[raw_codes]
+        prev_codes = np.roll(codes, 1)
+        prev_codes[0] = {tag: code for code, tag in enumerate(tags)}.get(self.last_tag, -2)
+        # a new run starts whenever the tag changes (every null tag row is a run of its own)
+        new_run = (codes != prev_codes) | (codes == -1)
+        runs = self.run + np.cumsum(new_run)
+        starts = np.flatnonzero(new_run & (codes >= 0))
+        self.run_tags.update(zip(runs[starts].tolist(), tags[codes[starts]]))
+
+        time = quantize_time(chunk['Timestamp'])
+        prev_time = time.shift()
+        prev_time.iloc[0] = self.last_time
+        prev_runs = np.roll(runs, 1)
+        prev_runs[0] = self.run
+        # rows falling in the same second as the previous row of their run can never be kept
+        keep = ~((time == prev_time).values & (runs == prev_runs))
+
+        kept_codes = codes[keep]
+        tag_values = np.full(len(tags) + 1, np.nan)
+        for code in np.unique(kept_codes[kept_codes >= 0]):
+            tag_values[code] = clean_tag(tags[code])
+        piece = pd.DataFrame({
+            'time': time.values[keep],
+            'Power': chunk['Power'].values[keep],
+            'Luminance': chunk['Luminance'].values[keep],
+            'Tag': tag_values[kept_codes],
+            'run': runs[keep]
+        })
+        self.pieces.append(piece)
+
+        self.run = int(runs[-1])
+        self.last_tag = tags[codes[-1]] if codes[-1] >= 0 else None
+        self.last_time = time.iloc[-1]
+        return piece
+
+    def get_state(self):
+        """Return the state carried between chunks as a json serializable dictionary."""
+        return {
+            'run': int(self.run),
+            'last_tag': None if pd.isna(self.last_tag) else self.last_tag,
+            'last_time': None if pd.isna(self.last_time) else str(self.last_time),
+            'run_tags': [[int(run), tag] for run, tag in self.run_tags.items()],
+            'tag_counts': {tag: int(count) for tag, count in self.tag_counts.items()},
+        }
+
+    def set_state(self, state):
+        """Restore the state returned by get_state (reduced rows are restored through pieces)."""
+        self.run = state['run']
+        self.last_tag = state['last_tag']
+        self.last_time = None if state['last_time'] is None else pd.Timestamp(state['last_time'])
+        self.run_tags = {run: tag for run, tag in state['run_tags']}
+        self.tag_counts = dict(state['tag_counts'])
+
+    def result(self):
+        """Return the reduced datalog rows (time, Power, Luminance, Tag) fed so far."""
+        columns = ['time', 'Power', 'Luminance', 'Tag']
+        if not self.pieces:
+            return pd.DataFrame(columns=columns)
+        # only the last run of each tag survives a rewind
+        last_runs = {tag: run for run, tag in self.run_tags.items()}
+        discarded = [run for run, tag in self.run_tags.items() if last_runs[tag] != run]
+        df = pd.concat(self.pieces)
+        rewound = df['run'].isin(discarded)
+        log_rewinds('Tag', len(discarded), rewound.sum())
+        df = df[~rewound]
+        df = df.drop_duplicates(subset=['time'])
+        df = df.dropna(subset=['Tag'])
+        return df.reset_index(drop=True)[columns]
+
+
+def reduce_datalog(path, chunksize=DATALOG_CHUNKSIZE):
+    """Stream a datalog csv through a DatalogReducer, reading at most chunksize rows at a time."""
+    reducer = DatalogReducer()
+    chunks = pd.read_csv(path, usecols=DATALOG_COLS, dtype={'Tag': str}, parse_dates=['Timestamp'],
+                         chunksize=chunksize)
+    for chunk in chunks:
+        reducer.feed(chunk)
+    return reducer
+
+
 def merge_test_data(test_seq_df, data_df):
     """
     Merges test output data, test sequence data, and APL data
     into a single cleaned csv ready to be used in data report script.
     """
-    ddf = data_df.copy()
-    ddf['Tag'] = ddf['Tag'].apply(lambda tag: tag[0] if 'camera ccf' in str(tag) else tag)
-    merged_df = remove_rows_rewind(ddf)
-    merged_df['time'] = merged_df['Timestamp'].apply(round_time)
-    merged_df = merged_df.drop_duplicates(subset=['time'])
-    merged_df = merged_df.reset_index()[['time', 'Power', 'Luminance', 'Tag']]
-    merged_df = merged_df.dropna(subset=['Tag'])
-    merged_df['Tag'] = merged_df['Tag'].apply(clean_tag)
-    merged_df = merged_df.dropna(subset=['Tag'])
+    reducer = DatalogReducer()
+    reducer.feed(data_df)
+    return merge_reduced_data(test_seq_df, reducer.result(), reducer.tag_counts)
+
+
+def merge_reduced_data(test_seq_df, merged_df, tag_counts):
+    """Merges reduced datalog rows (see DatalogReducer) with test sequence data and APL data."""
     test_seq_df = add_stab_tests(test_seq_df, merged_df)
-    merged_df.columns = ['time', 'watts', 'nits', 'tag']
+    merged_df = merge_tests(test_seq_df, merged_df)
+    merged_df = add_waketimes(merged_df, test_seq_df, tag_counts)
+    return merged_df
+
+
+def merge_tests(test_seq_df, merged_df):
+    """
+    Merges reduced datalog rows with test sequence data (including stabilization tests, see add_stab_tests)
+    and APL data. Each test's rows only depend on its own reduced rows and test sequence row.
+    """
+    merged_df = merged_df.set_axis(['time', 'watts', 'nits', 'tag'], axis=1)
+    # rows of tags missing from the test sequence are cut off anyway, dropping them first keeps the test sequence
+    # columns' dtypes independent of which tests are merged together
+    merged_df = merged_df[merged_df['tag'].isin(test_seq_df['tag'])]
     merged_df = merged_df.merge(test_seq_df, on='tag', how='left')
     merged_df = cut_off_intros(merged_df)
     merged_df = add_apl_data(merged_df)
-    merged_df = add_waketimes(merged_df, test_seq_df, data_df)
     return merged_df
-
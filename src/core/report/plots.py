@@ -1,18 +1,32 @@
 from collections import OrderedDict
 from functools import partial
+import io
+import warnings
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib import rcParams, transforms
 import matplotlib.lines as mlines
-from seaborn import heatmap
+from seaborn import cm, despine
+import colour
 from colour.models import BT2020_COLOURSPACE, BT709_COLOURSPACE
 from colour.colorimetry.spectrum import SpectralDistribution
 from colour.plotting import plot_sds_in_chromaticity_diagram_CIE1931
-from colour.plotting import plot_RGB_colourspaces_in_chromaticity_diagram_CIE1931
+from colour.plotting import plot_chromaticity_diagram_CIE1931
+from . import cache
+from ..filefuncs import APPDATA_DIR
 
 rcParams['font.family'] = "sans-serif"
 rcParams['font.sans-serif'] = "Calibri"
 
+# rendered chromaticity backgrounds, one per set of drawing parameters (see chromaticity_background_key)
+CHROMATICITY_BACKGROUNDS = APPDATA_DIR.joinpath('chromaticity-backgrounds')
+CHROMATICITY_BACKGROUND_BYTES = 10 * 2 ** 20
+CHROMATICITY_SIZE = 5.5
+CHROMATICITY_DPI = 200
+CHROMATICITY_EXTENT = (-.1, .9, -.1, .9)
+CHROMATICITY_GAMUTS = [(BT2020_COLOURSPACE, '#F44336'), (BT709_COLOURSPACE, '#607D8B')]
+
 def format_ax(ax=None, xlabel='Time (s)', ylabel='Power (W)'):
     if not ax:
         ax = plt.gca()
@@ -22,14 +36,35 @@ def format_ax(ax=None, xlabel='Time (s)', ylabel='Power (W)'):
     ax.tick_params(labelsize=14)
 
 
+def downsample(series, width):
+    """
+    Reduce a series to the first, last, minimum and maximum point of each of width equal x ranges (pixel columns),
+    which draws the same line as the full series at that width. Null values are kept where a column has no others.
+    """
+    if len(series) <= 4 * width:
+        return series
+    x = series.index.values.astype(float)
+    y = series.values.astype(float)
+    columns = np.clip(((x - x[0]) / (x[-1] - x[0]) * width).astype(int), 0, width - 1)
+    starts = np.flatnonzero(np.diff(columns, prepend=-1))
+    stops = np.append(starts[1:], len(columns)) - 1
+    # sorted by column then value, the first row of each column is its minimum and the last its maximum
+    by_min = np.lexsort((np.where(np.isnan(y), np.inf, y), columns))
+    by_max = np.lexsort((np.where(np.isnan(y), -np.inf, y), columns))
+    keep = np.unique(np.concatenate([starts, stops, by_min[starts], by_max[stops]]))
+    return series.iloc[keep]
+
+
 def time_series(series_list, labels=None, colors=None, ax=None, show_avg=True, **kwargs):
     if not ax:
         ax = plt.gca()
     if not colors:
         colors = [None] * len(series_list)
     format_ax(ax, **kwargs)
+    # long tests have far more samples than the axes has pixel columns
+    width = max(int(ax.get_window_extent().width), 1)
     for series, color in zip(series_list, colors):
-        ax.plot(series, color=color)
+        ax.plot(downsample(series, width), color=color)
     # make sure y axis range is at least 1
     ymin, ymax = ax.get_ylim()
     yrange = ymax - ymin
@@ -72,14 +107,14 @@ def standard(tdf):
     return fig
 
 
-def overlay(df, test_names):
+def overlay(test_store, test_names):
     fig, ax = plt.subplots(figsize=(10, 7))
     series_list, labels = [], []
     colors = ['tab:blue', 'tab:orange', 'tab:green', 'tab:red', 'tab:cyan', 'tab:pink']
     averages = []
 
     for i, test in enumerate(test_names):
-        tdf = df.query('test_name==@test').reset_index()
+        tdf = test_store.test(test).reset_index()
         series_list.append(tdf['watts'])
         labels.append(test)
         avg = round(tdf['watts'].mean(), 1)
@@ -95,16 +130,16 @@ def overlay(df, test_names):
     return fig
 
 
-def standby(df, test_names):
+def standby(test_store, test_names):
     fig, ax = plt.subplots(figsize=(12, 10))
     fig.tight_layout(h_pad=-2)
     watts_series_list = []
     handles = []
     colors = ['tab:blue', 'tab:orange', 'tab:green', 'tab:red', 'tab:cyan', 'tab:pink']
     for i, test in enumerate(test_names):
-        tdf = df[df['test_name'] == test].reset_index().iloc[13:-30]
+        tdf = test_store.test(test).reset_index().iloc[13:-30]
         watts_series_list.append(tdf['watts'])
-        if 'qs' in df.columns:
+        if 'qs' in test_store.df.columns:
             label = test
             color = colors[i]
 
@@ -133,11 +168,11 @@ def standby(df, test_names):
 #     return fig
 
 
-def apl_watts_scatter(df, test_names):
+def apl_watts_scatter(test_store, test_names):
     '''makes scatter plot of APL (x axis) vs Watts (y axis) for a single test
     also plots a natural log curve of best fit'''
     fig, ax = plt.subplots(figsize=(10, 10))
-    tdf = df[df['test_name'] == test_names].copy()
+    tdf = test_store.test(test_names).copy()
 
     format_ax(ax, xlabel="APL' (%)", ylabel='Power (W)')
     ax.scatter(tdf["APL'"], tdf['watts'])
@@ -280,6 +315,22 @@ def all_dimming_lines(rsdf):
     return fig
 
 
+def power_cap_knee(limit_func, area):
+    """
+    First whole luminance (from 2 nits) at which the power limit stops increasing, i.e. one past the point
+    where the limit line reaches the power cap. Returns None for limit functions without a power cap.
+    """
+    if 'power_cap_func' not in limit_func.keywords:
+        return None
+    limit_line = partial(limit_func, area=area, power_cap_func=None)
+    intercept = limit_line(luminance=0)
+    slope = limit_line(luminance=1) - intercept
+    cap = limit_func.keywords['power_cap_func'](area, 0)
+    if slope <= 0:
+        return 2
+    return max(2, int(np.ceil((cap - intercept) / slope)) + 1)
+
+
 def stacked_dimming_line_scatter(pps_list, rsdf, area, limit_funcs):
     def get_points(pps, rsdf):
         label_dict = {
@@ -323,13 +374,8 @@ def stacked_dimming_line_scatter(pps_list, rsdf, area, limit_funcs):
             lums = [point[0] for label, point in points.items() if label != 'Measured']
             limit_func = limit_funcs.get(pps)
             max_lum = max(max(lums) * 1.25, max_lum)
-            if 'power_cap_func' in limit_func.keywords:
-                lum_bend = 2
-                prev_lim, new_lim = limit_func(area, luminance=lum_bend - 1), limit_func(area, luminance=lum_bend)
-                while new_lim > prev_lim:
-                    prev_lim = new_lim
-                    lum_bend += 1
-                    new_lim = limit_func(area, luminance=lum_bend)
+            lum_bend = power_cap_knee(limit_func, area)
+            if lum_bend is not None:
                 max_lum = max(max_lum, lum_bend * 1.25)
             
         return max_lum
@@ -388,7 +434,7 @@ def stacked_dimming_line_scatter(pps_list, rsdf, area, limit_funcs):
         #     max_lum = max(max_lum, lum_bend * 1.25)
         
         xs = np.arange(min_lum, max_lum, .1)
-        ys = [limit_func(area=area, luminance=i) for i in xs]
+        ys = limit_func(area=area, luminance=xs)
         ax.plot(xs, ys, color='tab:orange')
     
         handle = mlines.Line2D([], [], linewidth=1, label=f'Power Limit', color='tab:orange')
@@ -479,18 +525,12 @@ def dimming_line_scatter(pps, rsdf, area, limit_funcs):
 
     min_lum, max_lum = 0, max(lums)*1.25
     
-    if 'power_cap_func' in limit_func.keywords:
-        lum_bend = 2
-        prev_lim, new_lim = limit_func(area, luminance=lum_bend-1), limit_func(area, luminance=lum_bend)
-        while new_lim > prev_lim:
-            prev_lim = new_lim
-            lum_bend += 1
-            new_lim = limit_func(area, luminance=lum_bend)
-        
+    lum_bend = power_cap_knee(limit_func, area)
+    if lum_bend is not None:
         max_lum = max(max_lum, lum_bend*1.25)
     
     xs = np.arange(min_lum, max_lum, .1)
-    ys = [limit_func(area=area, luminance=i) for i in xs]
+    ys = limit_func(area=area, luminance=xs)
     plt.plot(xs, ys, color='tab:orange')
     
     handle = mlines.Line2D([], [], linewidth=1, label=f'Power Limit', color='tab:orange')
@@ -516,7 +556,7 @@ def x_nits(light_df):
 def y_nits(light_df):
     # light_df.to_csv('light_df.csv')
     ys = light_df.mean(axis=1)
-    ys.index = map(lambda x: x - 100, reversed(ys.index))
+    ys.index = ys.index[::-1] - 100
     base = plt.gca().transData
     rot = transforms.Affine2D().rotate_deg(-90)
     fig = ys.plot(figsize=(8, 12), legend=False, transform=rot + base, ylim=(0, 100), xlim=(0, max(ys)*1.05)).get_figure()
@@ -528,14 +568,37 @@ def y_nits(light_df):
     return fig
 
 
+def block_mean(values, max_shape):
+    """Average a 2D array over equal blocks so that it has at most max_shape (rows, columns). NaN values are skipped."""
+    fy, fx = (max(-(-n // m), 1) for n, m in zip(values.shape, max_shape))
+    if fy == fx == 1:
+        return values
+    ny, nx = -(-values.shape[0] // fy), -(-values.shape[1] // fx)
+    # pad with NaN up to whole blocks
+    padded = np.full((ny * fy, nx * fx), np.nan)
+    padded[:values.shape[0], :values.shape[1]] = values
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmean(padded.reshape(ny, fy, nx, fx), axis=(1, 3))
+
+
 def nits_heatmap(light_df):
     fig, ax = plt.subplots(figsize=(19.2/1.5, 10.8/1.5))
     format_ax(ax=ax, xlabel='Distance From Left Edget', ylabel='Distance From Bottom Edge')
-    a = np.array(light_df).ravel()
-    vmax = np.percentile(a, 95)
-    heatmap(light_df, ax=ax, vmin=0, vmax=vmax)
-    ax.collections[0].colorbar.set_label('Luminance\n(Nits)', fontsize=16)
-    y_count, x_count = light_df.shape
+    values = light_df.values.astype(float)
+    vmax = np.percentile(values.ravel(), 95)
+    y_count, x_count = values.shape
+    # one image pixel per screen pixel is enough, the camera grid is averaged down to the axes size
+    bbox = ax.get_window_extent()
+    blocks = block_mean(values, (max(int(bbox.height), 1), max(int(bbox.width), 1)))
+    by, bx = -(-y_count // blocks.shape[0]), -(-x_count // blocks.shape[1])
+    img = ax.imshow(blocks, cmap=cm.rocket, vmin=0, vmax=vmax, aspect='auto', interpolation='nearest',
+                    extent=(0, blocks.shape[1] * bx, blocks.shape[0] * by, 0))
+    ax.set_xlim(0, x_count)
+    ax.set_ylim(y_count, 0)
+    cbar = fig.colorbar(img, ax=ax)
+    cbar.outline.set_linewidth(0)
+    cbar.set_label('Luminance\n(Nits)', fontsize=16)
     ax.set_xticks(range(0, x_count+1, int(x_count/10)))
     ax.set_xticklabels(range(0, 101, 10))
     xlabel = 'Distance From Left Edge \n(% of TV Width)'
@@ -544,10 +607,7 @@ def nits_heatmap(light_df):
     ax.set_yticklabels(range(100, -1, -10))
     ylabel = 'Distance From Bottom Edge\n(% of TV Height)'
     format_ax(xlabel=xlabel, ylabel=ylabel)
-    ax.spines['bottom'].set_color('0.5')
-    ax.spines['top'].set_color('0.5')
-    ax.spines['right'].set_color('0.5')
-    ax.spines['left'].set_color('0.9')
+    despine(ax=ax, left=True, bottom=True)
     fig.subplots_adjust(top=.97, bottom=.14, right=.99)
     plt.close()
     return fig
@@ -603,18 +663,66 @@ def brightness_loss(df):
     return fig
 
 
+def chromaticity_background_key():
+    """Hash of the drawing code, parameters and library versions the chromaticity background depends on."""
+    gamuts = [(np.asarray(colour_space.primaries), np.asarray(colour_space.whitepoint), color)
+              for colour_space, color in CHROMATICITY_GAMUTS]
+    return cache.hash_objects(chromaticity_background, gamuts, CHROMATICITY_EXTENT, CHROMATICITY_SIZE,
+                              CHROMATICITY_DPI, colour.__version__, matplotlib.__version__)
+
+
+def chromaticity_background():
+    """
+    Return the static part of the chromaticity diagram (CIE 1931 horseshoe, BT.2020 and BT.709 triangles and
+    their whitepoint) as an RGBA image spanning CHROMATICITY_EXTENT. It is identical for every TV, so it is
+    rendered once and kept as a png in the appdata folder, named by a hash of everything it is drawn from.
+    """
+    backgrounds = cache.FigureCache(CHROMATICITY_BACKGROUNDS, max_bytes=CHROMATICITY_BACKGROUND_BYTES)
+    key = chromaticity_background_key()
+    png = backgrounds.get(key)
+    if png is not None:
+        try:
+            return plt.imread(io.BytesIO(png))
+        except (OSError, SyntaxError, ValueError):
+            pass
+    fig = plt.figure(figsize=(CHROMATICITY_SIZE, CHROMATICITY_SIZE))
+    ax = fig.add_axes([0, 0, 1, 1])
+    plot_chromaticity_diagram_CIE1931(axes=ax, standalone=False)
+    for colour_space, color in CHROMATICITY_GAMUTS:
+        primaries = np.vstack([colour_space.primaries, colour_space.primaries[0]])
+        ax.plot(primaries[:, 0], primaries[:, 1], marker='o', color=color)
+        ax.plot(*colour_space.whitepoint, marker='o', color=color)
+    ax.set_xlim(CHROMATICITY_EXTENT[:2])
+    ax.set_ylim(CHROMATICITY_EXTENT[2:])
+    ax.set_title('')
+    ax.axis('off')
+    imgdata = io.BytesIO()
+    fig.savefig(imgdata, format='png', dpi=CHROMATICITY_DPI, transparent=True)
+    plt.close(fig)
+    backgrounds.put(key, imgdata.getvalue())
+    imgdata.seek(0)
+    return plt.imread(imgdata)
+
+
 def chromaticity(spectral_df):
+    fig, ax = plt.subplots(figsize=(10, 7))
+    ax.imshow(chromaticity_background(), extent=CHROMATICITY_EXTENT, interpolation='hanning')
+    # only the measured spectra are drawn on top of the cached background
     sd_list = [SpectralDistribution(spectral_df[color], name=color) for color in spectral_df.columns]
-    callable = partial(plot_sds_in_chromaticity_diagram_CIE1931, sd_list)
-    colour_spaces = [BT2020_COLOURSPACE, BT709_COLOURSPACE]
-    fig, ax = plot_RGB_colourspaces_in_chromaticity_diagram_CIE1931(
-        colourspaces=colour_spaces,
-        chromaticity_diagram_callable_CIE1931=callable,
+    plot_sds_in_chromaticity_diagram_CIE1931(
+        sd_list,
+        chromaticity_diagram_callable_CIE1931=lambda **kwargs: None,
+        axes=ax,
         standalone=False
     )
-    fig.set_size_inches(10, 7)
-    ax.legend(handles=ax.legend().legendHandles[-2:])
-    format_ax(xlabel='CIE X', ylabel='CIE Y')
+    ax.set_xlim(CHROMATICITY_EXTENT[:2])
+    ax.set_ylim(CHROMATICITY_EXTENT[2:])
+    ax.set_aspect('equal')
+    handles = [mlines.Line2D([], [], marker='o', color=color, label=colour_space.name)
+               for colour_space, color in CHROMATICITY_GAMUTS]
+    ax.legend(handles=handles)
+    format_ax(ax, xlabel='CIE X', ylabel='CIE Y')
     ax.set_title('CIE 1931 2 Degree Standard Observer', fontsize=24)
+    fig.tight_layout()
     plt.close()
-    return fig
\ No newline at end of file
+    return fig
@@ -0,0 +1,92 @@
+"""Draw independent report figures in worker processes and return them as PNG bytes."""
+import inspect
+import io
+import logging
+import os
+import sys
+from functools import lru_cache
+from multiprocessing import Pool
+from matplotlib import rcParams
+from . import cache
+from ..filefuncs import get_cache_dir
+
+
+RENDER_WORKERS = min(8, os.cpu_count() or 1)
+
+figure_cache = None
+
+
+def use_figure_cache(data_folder):
+    """Reuse figures rendered by previous runs, kept in the data folder's Cache/figures folder."""
+    global figure_cache
+    figure_cache = cache.FigureCache(get_cache_dir(data_folder).joinpath('figures'))
+
+
+@lru_cache()
+def module_hash(module_name):
+    """Hash of a module's source file, so that figures get redrawn when the plot helpers change."""
+    return cache.hash_files([inspect.getfile(sys.modules[module_name])])
+
+
+def figure_key(plot_func, args):
+    """Hash of the plot function (with the source of its module), its input data and the matplotlib style."""
+    return cache.hash_objects(module_hash(plot_func.__module__), plot_func, args, sorted(rcParams.items()))
+
+
+def init_worker():
+    """Use the non-interactive Agg backend in render workers."""
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def render_png(plot_func, *args):
+    """Draw plot_func(*args) and return the figure rasterized to PNG bytes."""
+    fig = plot_func(*args)
+    imgdata = io.BytesIO()
+    fig.savefig(imgdata)
+    return imgdata.getvalue()
+
+
+def render_job(plot_func, *args):
+    """render_png for a job of render_pngs: a failing figure is logged and returned as None."""
+    try:
+        return render_png(plot_func, *args)
+    except Exception:
+        logging.exception(f'{plot_func.__name__} failed')
+        return None
+
+
+def render_pngs(jobs, workers=RENDER_WORKERS):
+    """
+    Render a list of (plot_func, args) jobs, returning the PNG bytes of each figure in job order.
+    plot_func must be a module level function and args picklable; only the PNG bytes are sent back.
+    Figures found in the figure cache (see use_figure_cache) are not redrawn. A job whose plot_func raises
+    only fails its own figure, which is returned as None.
+    """
+    keys = [figure_key(*job) if figure_cache is not None else None for job in jobs]
+    pngs = [figure_cache.get(key) if key else None for key in keys]
+    missing = [i for i, png in enumerate(pngs) if png is None]
+    missing_jobs = [(jobs[i][0], *jobs[i][1]) for i in missing]
+    if workers <= 1 or len(missing_jobs) <= 1:
+        rendered = [render_job(*job) for job in missing_jobs]
+    else:
+        with Pool(min(workers, len(missing_jobs)), initializer=init_worker) as pool:
+            rendered = pool.starmap(render_job, missing_jobs)
+    for i, png in zip(missing, rendered):
+        pngs[i] = png
+        if png is None:
+            logging.warning(f'{jobs[i][0].__name__} figure {i + 1} of {len(jobs)} was not drawn')
+        elif keys[i]:
+            figure_cache.put(keys[i], png)
+    return pngs
+
+
+def render(plot_func, *args):
+    """Render a single figure in this process (through the figure cache), returning PNG bytes. Errors are raised."""
+    key = figure_key(plot_func, args) if figure_cache is not None else None
+    png = figure_cache.get(key) if key else None
+    if png is None:
+        png = render_png(plot_func, *args)
+        if key:
+            figure_cache.put(key, png)
+    return png
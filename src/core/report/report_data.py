@@ -1,8 +1,8 @@
 import sys
 import os
-import random
 import shutil
-from collections import defaultdict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from functools import partial
 import warnings
@@ -10,13 +10,14 @@ import numpy as np
 import pandas as pd
 from scipy.stats import linregress
 from colour.models import BT2020_COLOURSPACE, BT709_COLOURSPACE
-from colour import XYZ_to_Lab, Lab_to_LCHab
-from . import merge
-from ..error_handling import permission_popup, except_none_log
-from ..filefuncs import archive
+from . import merge, datalog, cache, gamut
+from .store import TestDataStore
+from .spectral import SpectralProfile
+from ..error_handling import permission_popup, except_none_log, run_main_thread_calls
+from ..filefuncs import archive, get_cache_dir
 
 @except_none_log
-def get_test_specs_df(merged_df, paths, report_type, clean=False):
+def get_test_specs_df(paths, report_type, clean=False):
     """Create a dataframe from test-metadata.csv and test data which displays the test specifics."""
     if report_type == 'pcl' and paths['entry_forms'] is not None:
         test_specs_df = pd.read_excel(paths['entry_forms'], sheet_name='Misc', header=None, index_col=0)
@@ -63,25 +64,24 @@ def get_test_specs_df(merged_df, paths, report_type, clean=False):
 
 @except_none_log
 @permission_popup
-def get_results_summary_df(merged_df, data_folder, waketimes):
+def get_results_summary_df(test_store, data_folder, waketimes):
     """Create a dataframe with one line per test showing test info and test results (average watts and nits)."""
-    rsdf = merged_df.groupby(['tag']).first()
-
     cols = ['test_name', 'test_time', 'preset_picture', 'video', 'abc', 'lux', 'qs']
-    cols = [col for col in cols if col in rsdf.columns]
-    rsdf = rsdf[cols]
+    cols = [col for col in cols if col in test_store.df.columns]
     avg_cols = ['watts', 'nits', "APL'"]
-    rsdf = pd.concat([rsdf, merged_df.groupby(['tag']).mean()[avg_cols]], axis=1)
+    stats = {col: (col, 'first') for col in cols}
+    stats.update({col: (col, 'mean') for col in avg_cols})
+    # standby power is the average of the last 20 minutes of the test
+    standby_cols = ['watts', 'nits']
+    stats.update({f'{col} last 20': (col, 'tail_mean') for col in standby_cols})
+    rsdf = test_store.aggregate(stats, tail=20 * 60)
+
+    standby = rsdf['test_name'].astype(str).str.contains('standby', regex=False).values
+    for col in standby_cols:
+        rsdf.loc[standby, col] = rsdf.loc[standby, f'{col} last 20']
+    rsdf = rsdf[cols + avg_cols]
     rsdf['waketime'] = rsdf['test_name'].apply(waketimes.get)
 
-    for i, row in rsdf.reset_index().iterrows():
-        if 'standby' in row['test_name']:
-            # todo: handle standby test not being long enough
-            if len(merged_df) > (20*60):
-                last20_df = merged_df[merged_df['tag'] == row['tag']].iloc[-20 * 60:]
-                for col in ['watts', 'nits']:
-                    rsdf.loc[row['tag'], col] = last20_df[col].mean()
-
     rsdf.to_csv(Path(data_folder).joinpath('results-summary.csv'))
     return rsdf
 
@@ -115,44 +115,42 @@ def get_compliance_summary_df(on_mode_df, standby_df, report_type, hdr):
 @except_none_log
 def get_on_mode_df(rsdf, limit_funcs, area, limit_type, hdr):
     """Create a dataframe and corresponding reportlab TableStyle data which displays the results of on mode testing."""
-    def add_pps_tests(on_mode_df, cdf, abc_off_test, abc_on_tests, limit_func):
-        on_mode_df = on_mode_df.append(cdf.loc[abc_off_test])
+    def add_pps_tests(rows, cdf, abc_off_test, abc_on_tests, limit_func):
+        abc_off_row = cdf.loc[abc_off_test].copy()
+        rows.append(abc_off_row)
 
-        abc_off_pwr = on_mode_df.loc[abc_off_test, 'watts']
-        abc_off_lum = on_mode_df.loc[abc_off_test, 'nits']
+        abc_off_pwr = abc_off_row['watts']
+        abc_off_lum = abc_off_row['nits']
         if abc_on_tests and limit_type != 'estar':
-            for test in abc_on_tests:
-                on_mode_df = on_mode_df.append(cdf.loc[test])
-            abc_on_pwr = on_mode_df.loc[abc_on_tests, 'watts'].mean()
-            abc_on_lum = on_mode_df.loc[abc_on_tests, 'nits'].mean()
+            rows.extend(cdf.loc[test] for test in abc_on_tests)
+            abc_on_pwr = cdf.loc[abc_on_tests, 'watts'].mean()
+            abc_on_lum = cdf.loc[abc_on_tests, 'nits'].mean()
             measured = {
                 'nits': np.mean([abc_on_lum, abc_off_lum]),
                 'watts': np.mean([abc_on_pwr, abc_off_pwr])
             }
-
-            measured_name = f'{abc_off_test}_measured'
-            on_mode_df = on_mode_df.append(pd.Series(data=measured, name=measured_name))
-            limit = limit_func(area=area, luminance=on_mode_df.loc[measured_name, 'nits'])
-            on_mode_df.loc[measured_name, 'limit'] = limit
+            measured['limit'] = limit_func(area=area, luminance=measured['nits'])
+            rows.append(pd.Series(data=measured, name=f'{abc_off_test}_measured'))
         else:
-            limit = limit_func(area=area, luminance=on_mode_df.loc[abc_off_test, 'nits'])
-            on_mode_df.loc[abc_off_test, 'limit'] = limit
-        return on_mode_df
+            abc_off_row['limit'] = limit_func(area=area, luminance=abc_off_lum)
+        return rows
 
     cdf = rsdf.set_index('test_name')
-    on_mode_df = cdf.drop(cdf.index)
+    rows = []
     
     def_abc_tests = [test for test in ['default_100', 'default_35', 'default_12', 'default_3'] if test in cdf.index]
-    on_mode_df = add_pps_tests(on_mode_df, cdf, 'default', def_abc_tests, limit_funcs['default'])
+    rows = add_pps_tests(rows, cdf, 'default', def_abc_tests, limit_funcs['default'])
 
     br_abc_tests = [test for test in ['brightest_100', 'brightest_35', 'brightest_12', 'brightest_3'] if
                     test in cdf.index]
-    on_mode_df = add_pps_tests(on_mode_df, cdf, 'brightest', br_abc_tests, limit_funcs['brightest'])
+    rows = add_pps_tests(rows, cdf, 'brightest', br_abc_tests, limit_funcs['brightest'])
     
     if hdr:
         hdr_abc_tests = [test for test in ['hdr10_100', 'hdr10_35', 'hdr10_12', 'hdr10_3'] if test in cdf.index]
-        on_mode_df = add_pps_tests(on_mode_df, cdf, 'hdr10', hdr_abc_tests, limit_funcs['hdr10'])
+        rows = add_pps_tests(rows, cdf, 'hdr10', hdr_abc_tests, limit_funcs['hdr10'])
 
+    on_mode_df = pd.DataFrame(rows, columns=list(cdf.columns) + ['limit'])
+    on_mode_df.index.name = 'test_name'
     on_mode_df = on_mode_df.reset_index()
 
     
@@ -161,8 +159,8 @@ def get_on_mode_df(rsdf, limit_funcs, area, limit_type, hdr):
     else:
         # on_mode_df['ratio'] = on_mode_df['watts'] / on_mode_df['limit']
         on_mode_df['gap'] =  on_mode_df['limit'] - on_mode_df['watts']
-        data = {'test_name': 'average_measured', 'gap': on_mode_df['gap'].mean()}
-        on_mode_df = on_mode_df.append(data, ignore_index=True)
+        average = pd.DataFrame([{'test_name': 'average_measured', 'gap': on_mode_df['gap'].mean()}])
+        on_mode_df = pd.concat([on_mode_df, average], ignore_index=True, sort=False)
     
     
     cols = ['test_name', 'preset_picture', 'abc', 'lux', 'nits', 'limit', 'watts', 'gap', 'result']
@@ -256,9 +254,10 @@ def get_limit_funcs(limit_type, adjustment_factor='4K'):
     power_cap_funcs = {func_name: partial(power_cap, **coeff_vals) for func_name, coeff_vals in power_cap_coeffs.items()}
     
     def power_limit(area, luminance, sf, a, b, c, d, power_cap_func=None):
-        limit = af_value * (sf * ((a * area + b) * luminance + c * area + d))
+        # luminance can be a single value or an array of values
+        limit = af_value * (sf * ((a * area + b) * np.asarray(luminance) + c * area + d))
         if power_cap_func is not None:
-            return min(limit, power_cap_func(area, luminance))
+            return np.minimum(limit, power_cap_func(area, luminance))
         else:
             return limit
     
@@ -278,27 +277,28 @@ def get_status_df(test_seq_df, merged_df, paths, data_folder):
     status_df = status_df[status_df['test_name'] != 'screen_config']
     status_df = status_df[~status_df['test_name'].str.contains('ccf')]
     if merged_df is not None and isinstance(merged_df, pd.DataFrame) and not merged_df.empty:
-        def get_status(test_name):
+        # one pass over merged_df: the last row of every test (in merged_df order)
+        last_rows = merged_df[['test_name', 'time', 'waketime']].dropna(subset=['test_name'])
+        last_rows = last_rows.drop_duplicates('test_name', keep='last')
+        completion_times = dict(zip(last_rows['test_name'], last_rows['time']))
+        waketimes = dict(zip(last_rows['test_name'], last_rows['waketime']))
+        stab_times = [time for test_name, time in completion_times.items() if 'stabilization' in test_name]
         
-            default_check = lambda: test_name in merged_df['test_name'].unique()
-            status_checker = defaultdict(default_check)
-            status_checker.update({
-                'lum_profile': bool(paths.get('lum_profile')),
-                'camera_ccf_default': bool(paths.get('ccf')),
-                'stabilization': 'stabilization1' in merged_df['test_name'].unique(),
-                'active_low_waketime': pd.notna(merged_df.query('test_name=="standby_active_low"').reset_index()['waketime'].get(0))
-                    # pd.notna(
-                    # merged_df[merged_df['test_name']=='standby_active_low'].iloc[0]['waketime'])
-            })
-            return {True: 'Run', False: 'Not Run'}.get(status_checker[test_name])
+        status_checker = {
+            'lum_profile': bool(paths.get('lum_profile')),
+            'camera_ccf_default': bool(paths.get('ccf')),
+            'stabilization': 'stabilization1' in completion_times,
+            'active_low_waketime': pd.notna(waketimes.get('standby_active_low')),
+        }
+        def get_status(test_name):
+            return {True: 'Run', False: 'Not Run'}.get(status_checker.get(test_name, test_name in completion_times))
         status_df['status'] = status_df['test_name'].apply(get_status)
         def get_completion_time(row):
             if row['status'] == 'Run':
-                if row['test_name'] in merged_df['test_name'].unique():
-                    return merged_df.groupby('test_name').last().loc[row['test_name']]['time']
+                if row['test_name'] in completion_times:
+                    return completion_times[row['test_name']]
                 elif row['test_name'] == 'stabilization':
-                    mask = merged_df['test_name'].apply(lambda test_name: 'stabilization' in test_name)
-                    return merged_df[mask].iloc[-1]['time']
+                    return stab_times[-1]
                 elif row['test_name'] == 'lum_profile':
                     return str(pd.Timestamp(os.path.getmtime(paths.get('lum_profile')), unit='s'))
 
@@ -314,38 +314,90 @@ def get_status_df(test_seq_df, merged_df, paths, data_folder):
 @permission_popup
 def get_test_seq_df(paths):
     return pd.read_csv(paths['test_seq'])
-    
+
+
+# bump when merge output changes so that cached merged data gets rebuilt
+MERGED_CACHE_VERSION = 1
+
+def get_merged_cache_key(paths, old_merged):
+    """Hash of every file merged_df is built from."""
+    input_paths = [paths['test_data'], paths['test_seq'], old_merged] + get_apl_paths()
+    return cache.hash_files(input_paths, MERGED_CACHE_VERSION)
+
+def get_apl_paths():
+    return [Path(sys.path[0]).joinpath(file) for file in merge.APL_FILES.values()]
+
 @except_none_log
 @permission_popup
-def get_merged_df(test_seq_df, paths, data_folder):
-    
-    data_df = pd.read_csv(paths['test_data'], parse_dates=['Timestamp'])
-    merged_df = merge.merge_test_data(test_seq_df, data_df)
+def get_merged_df(test_seq_df, paths, data_folder, chunksize=merge.DATALOG_CHUNKSIZE, incremental=True,
+                  compact=False):
+    """
+    Merge the datalog with the test sequence and save the result as merged.csv.
+    The datalog is streamed chunksize rows at a time (chunksize=None reads it all at once). In incremental
+    mode only datalog rows appended since the previous merge are read and only the tests they belong to are merged
+    and rewritten in merged.csv (see datalog.py), unless merged.csv was written by something else.
+    Otherwise the result is cached and reused as long as the datalog, test sequence, APL and merged.csv files are
+    unchanged.
+    In compact mode the returned merged_df uses categoricals and float32 (see merge.compact_merged_df).
+    """
+    merged_path = Path(data_folder).joinpath('merged.csv')
+    if incremental and chunksize is not None and (paths['old_merged'] is None or (
+            Path(paths['old_merged']) == merged_path and datalog.owns_merged_csv(data_folder, merged_path))):
+        base_key = cache.hash_files([paths['test_seq']] + get_apl_paths(), MERGED_CACHE_VERSION)
+        merged_df = datalog.merge_datalog_incremental(test_seq_df, paths['test_data'], data_folder, base_key,
+                                                      merged_path, chunksize=chunksize)
+        merge.log_memory(merged_df, 'merged_df')
+        return compact_merged_df(merged_df) if compact else merged_df
+
+    cache_path = get_cache_dir(data_folder).joinpath('merged.npz')
+    merged_df = cache.load_frame(cache_path, get_merged_cache_key(paths, paths['old_merged']))
+    if merged_df is not None:
+        merge.log_memory(merged_df, 'merged_df (cached)')
+        return compact_merged_df(merged_df) if compact else merged_df
+
+    if chunksize is None:
+        data_df = pd.read_csv(paths['test_data'], parse_dates=['Timestamp'])
+        merged_df = merge.merge_test_data(test_seq_df, data_df)
+    else:
+        reducer = merge.reduce_datalog(paths['test_data'], chunksize=chunksize)
+        reduced_df = reducer.result()
+        merge.log_memory(reduced_df, 'reduced datalog')
+        merged_df = merge.merge_reduced_data(test_seq_df, reduced_df, reducer.tag_counts)
+    merge.log_memory(merged_df, 'merged_df')
     merged_df['source'] = Path(paths['test_data']).name
     
     if paths['old_merged'] is not None:
         old_merged_df = pd.read_csv(paths['old_merged'])
         archive(paths['old_merged'])
-        old_merged_df = old_merged_df.append({'test_name':-1}, ignore_index=True)
+        old_merged_df = pd.concat([old_merged_df, pd.DataFrame({'test_name': [-1]})], ignore_index=True, sort=False)
         merged_df = pd.concat([old_merged_df, merged_df]).reset_index()[merged_df.columns]
         merged_df = merge.remove_rows_rewind(merged_df, col='test_name')
         merged_df = merged_df.query('test_name!=-1')
-        
-        
-    merged_df.to_csv(Path(data_folder).joinpath('merged.csv'), index=False)
-    
+        merge.log_memory(merged_df, 'merged_df (with old merged)')
+
+    merged_df.to_csv(merged_path, index=False)
+    # the merged.csv just written is picked up as old_merged by the next run
+    cache.save_frame(merged_df, cache_path, get_merged_cache_key(paths, merged_path))
     
+    return compact_merged_df(merged_df) if compact else merged_df
+
+
+def compact_merged_df(merged_df):
+    merged_df = merge.compact_merged_df(merged_df)
+    merge.log_memory(merged_df, 'merged_df (compact)')
     return merged_df
 
 @except_none_log
-def get_spectral_df(paths):
-    df = pd.read_csv(paths['spectral_profile']).iloc[39:]
-    
-    df = df.astype(float).set_index(df.columns[0])
-    df = df[df.columns[:4]]
-    df.columns = [i.split('(')[0].strip() for i in df.columns]
-    df.index.name = 'Wavelength (nm)'
-    return df
+def get_test_store(merged_df):
+    return TestDataStore(merged_df)
+
+@except_none_log
+def get_spectral_profile(paths):
+    return SpectralProfile(paths['spectral_profile'])
+
+@except_none_log
+def get_spectral_df(spectral_profile):
+    return spectral_profile.spectral_df
 
 @except_none_log
 @permission_popup
@@ -379,206 +431,105 @@ def get_spectral_summary_df(data):
     return spectral_summary_df
 
 @except_none_log
-def get_spectral_coordinates_df(paths):
-    df = pd.read_csv(paths['spectral_profile']).iloc[18:20]
-    df = df.set_index(df.columns[0]).astype(float)
-    df.index.name = ''
-    df = df[['Red(0)', 'Green(0)', 'Blue(0)']]
-    df.columns = ['Red', 'Green', 'Blue']
-    return df.reset_index()
-
-@except_none_log
-def get_washout_df(paths):
-    df = pd.read_csv(paths['spectral_profile'])
-    df = df.set_index(df.columns[0])
-    df.index.name = ''
-    df = df.iloc[12:15].T
-
-    df = df.reset_index()
-
-    df['color'] = df['index'].apply(lambda s: s.split('(')[0].strip())
-    df['angle'] = df['index'].apply(lambda s: s.split('(')[1].replace(')', '')).astype(int)
-
-    df['X'] = df['X'].astype(float)
-    df['Y'] = df['Y'].astype(float)
-    df['Z'] = df['Z'].astype(float)
-
-    df['normX'] = (df['X']/df['X'][0]).apply(lambda x: min(x, 1))
-    df['normY'] = (df['Y']/df['Y'][0]).apply(lambda x: min(x, 1))
-    df['normZ'] = (df['Z']/df['Z'][0]).apply(lambda x: min(x, 1))
-    lab = df[['normX', 'normY', 'normZ']].apply(XYZ_to_Lab, axis=1)
-    df['lchab'] = lab.apply(Lab_to_LCHab)
-    df['l'] = df['lchab'].apply(lambda x: x[0])
-
-    df['c'] = df['lchab'].apply(lambda x: x[1])
-    df['h'] = df['lchab'].apply(lambda x: x[2])
-    df = df[['color', 'angle', 'l', 'c', 'h']].set_index(['color', 'angle'])
-    df = df['c'].to_frame().reset_index()
-    df = df.pivot(index='angle', columns='color')
-    df.columns = [i[1] for i in df.columns]
-    for col in df.columns:
-        df[col] = (df[col]/df[col].values[0]).apply(lambda x: min(x, 1))
+def get_spectral_coordinates_df(spectral_profile):
+    return spectral_profile.coordinates_df
+
+@except_none_log
+def get_washout_df(spectral_profile):
+    angles, colors, chroma = spectral_profile.grid(spectral_profile.LCHab[:, 1])
+    washout = np.minimum(chroma / chroma[0], 1)
+    df = pd.DataFrame(washout, index=pd.Index(angles, name='angle'), columns=list(colors))
     df = df.drop('White', axis=1)
     return df
 
 @except_none_log
-def get_color_shift_df(paths):
-    df = pd.read_csv(paths['spectral_profile'])
-    df = df.set_index(df.columns[0])
-    df.index.name = ''
-
-    df = df.iloc[12:15].T
-
-    df = df.reset_index()
-
-    df['color'] = df['index'].apply(lambda s: s.split('(')[0].strip())
-    df['angle'] = df['index'].apply(lambda s: s.split('(')[1].replace(')', '')).astype(int)
-
-    df['X'] = df['X'].astype(float)
-    df['Y'] = df['Y'].astype(float)
-    df['Z'] = df['Z'].astype(float)
-
-    df['normX'] = (df['X']/df['X'][0]).apply(lambda x: min(x, 1))
-    df['normY'] = (df['Y']/df['Y'][0]).apply(lambda x: min(x, 1))
-    df['normZ'] = (df['Z']/df['Z'][0]).apply(lambda x: min(x, 1))
-    lab = df[['normX', 'normY', 'normZ']].apply(XYZ_to_Lab, axis=1)
-    df['lchab'] = lab.apply(Lab_to_LCHab)
-    df['l'] = df['lchab'].apply(lambda x: x[0])
-    df['l'] = df['l']
-    df['c'] = df['lchab'].apply(lambda x: x[1])
-    df['h'] = df['lchab'].apply(lambda x: x[2])
-    df = df[['color', 'angle', 'l', 'c', 'h']].set_index(['color', 'angle'])
-    df = df['h'].to_frame().reset_index()
-    df = df.pivot(index='angle', columns='color')
-    df.columns = [i[1] for i in df.columns]
-    for col in df.columns:
-        df[col] = (df[col]-df[col].values[0])
+def get_color_shift_df(spectral_profile):
+    angles, colors, hue = spectral_profile.grid(spectral_profile.LCHab[:, 2])
+    df = pd.DataFrame(hue - hue[0], index=pd.Index(angles, name='angle'), columns=list(colors))
     df = df.drop('White', axis=1)
     return df
 
 @except_none_log
-def get_brightness_loss_df(paths):
-    df = pd.read_csv(paths['spectral_profile'])
-    df = df.set_index(df.columns[0])
-    df.index.name = ''
-    df = df.iloc[12:15].T
-    df = df.reset_index()
-    df['color'] = df['index'].apply(lambda s: s.split('(')[0].strip())
-    df['angle'] = df['index'].apply(lambda s: s.split('(')[1].replace(')', '')).astype(int)
-    df['Y'] = df['Y'].astype(float)
-    df['normY'] = (df['Y'] / df['Y'][0]).apply(lambda x: min(x, 1))
-    df = df[['color', 'angle', 'normY']]
-    df = df.pivot(index='angle', columns='color')
-    df.columns = [i[1] for i in df.columns]
+def get_brightness_loss_df(spectral_profile):
+    df = spectral_profile.pivot(spectral_profile.norm_XYZ[:, 1])
     return df[['White']]
 
 
-def get_crossover_x(series, crossover_y):
-    dc_mask = (series > crossover_y) & (crossover_y > series.shift(-1))
-    dc_masked_series = series[dc_mask]
-    crossover_x = None
-    if len(dc_masked_series) > 0:
-        x1 = dc_masked_series.index[0]
-
-        x2 = series.index[list(series.index).index(x1) + 1]
-        y1 = series.loc[x1]
-        y2 = series.loc[x2]
-        slope = (y2 - y1) / (x2 - x1)
-        crossover_x = x1 + (crossover_y - y1) / slope
-        return crossover_x
-    uc_mask = ((series > crossover_y) & (crossover_y > series.shift(1)))
-    uc_masked_series = series[uc_mask]
-    if len(uc_masked_series) > 0:
-        x1 = uc_masked_series.index[0]
-
-        x2 = series.index[list(series.index).index(x1) - 1]
-        y1 = series.loc[x1]
-        y2 = series.loc[x2]
-        slope = (y2 - y1) / (x2 - x1)
-        crossover_x = x1 + (crossover_y - y1) / slope
-        return crossover_x
-    return crossover_x
+def get_crossovers(df, thresholds):
+    """
+    First x (index value) at which each column of df crosses each threshold, linearly interpolated between
+    the two points on either side. Downward crossings are looked for first, then upward ones.
+    Returns a frame with one row per threshold and one column per df column (NaN where there is no crossing).
+    """
+    x = df.index.values.astype(float)
+    y = df.values.astype(float)[:, :, None]
+    t = np.asarray(thresholds, dtype=float)
+    above, below = y > t, t > y
+    crossovers = np.full(above.shape[1:], np.nan)
+    if len(x) < 2:
+        return pd.DataFrame(crossovers.T, index=t, columns=df.columns)
+    # (first point, neighbouring point) pairs for downward then upward crossings
+    for crossing, offset in [(above[:-1] & below[1:], 1), (above[1:] & below[:-1], -1)]:
+        found = crossing.any(axis=0) & np.isnan(crossovers)
+        first = crossing.argmax(axis=0) + (offset == -1)
+        cols = np.arange(y.shape[1])[:, None]
+        x1, x2 = x[first], x[first + offset]
+        y1, y2 = y[first, cols, 0], y[first + offset, cols, 0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = (y2 - y1) / (x2 - x1)
+            crossovers = np.where(found, x1 + (t - y1) / slope, crossovers)
+    return pd.DataFrame(crossovers.T, index=t, columns=df.columns)
+
+def crossover_dict(crossovers, threshold):
+    """Crossovers of one threshold (see get_crossovers) as a dictionary, with None where there is no crossing."""
+    return {col: None if pd.isna(x) else x for col, x in crossovers.loc[threshold].items()}
 
 @except_none_log
 def get_washout_crossovers(washout_df):
-    crossovers = {}
-    for col in washout_df.columns:
-        crossovers[col] = get_crossover_x(series=washout_df[col], crossover_y=.8)
-    return crossovers
+    return crossover_dict(get_crossovers(washout_df, [.8]), .8)
 
 @except_none_log
 def get_color_shift_crossovers(color_shift_df):
-    pos_crossovers = {}
-    for col in color_shift_df.columns:
-        pos_crossovers[col] = get_crossover_x(series=color_shift_df[col], crossover_y=3)
-    neg_crossovers = {}
-    for col in color_shift_df.columns:
-        neg_crossovers[col] = get_crossover_x(series=color_shift_df[col], crossover_y=-3)
+    crossovers = get_crossovers(color_shift_df, [3, -3])
     crossovers = {
-        'positive': pos_crossovers,
-        'negative': neg_crossovers
+        'positive': crossover_dict(crossovers, 3),
+        'negative': crossover_dict(crossovers, -3)
     }
     return crossovers
 
 @except_none_log
 def get_brightness_loss_crossover(brightness_loss_df):
-    return get_crossover_x(series=brightness_loss_df['White'], crossover_y=.75)
+    return crossover_dict(get_crossovers(brightness_loss_df[['White']], [.75]), .75)['White']
     
 @except_none_log
-def get_coverage(coordinates_df, colorspace):
-    def point_on_triangle(pt1, pt2, pt3):
-        """Random point on the triangle with vertices pt1, pt2 and pt3."""
-        s, t = sorted([random.random(), random.random()])
-        return (s * pt1[0] + (t - s) * pt2[0] + (1 - t) * pt3[0],
-                s * pt1[1] + (t - s) * pt2[1] + (1 - t) * pt3[1])
-    
-    def isInside(x1, y1, x2, y2, x3, y3, x, y):
-        """A function to check whether point P(x, y) lies inside the triangle formed by A(x1, y1), B(x2, y2) and C(x3, y3)"""
-        
-        def area(x1, y1, x2, y2, x3, y3):
-            """A utility function to calculate area of triangle formed by (x1, y1), (x2, y2), and (x3, y3)"""
-            return abs((x1 * (y2 - y3) + x2 * (y3 - y1) + x3 * (y1 - y2)) / 2.0)
-            # Calculate area of triangle ABC
-        
-        A = area(x1, y1, x2, y2, x3, y3)
-        # Calculate area of triangle PBC
-        A1 = area(x, y, x2, y2, x3, y3)
-        # Calculate area of triangle PAC
-        A2 = area(x1, y1, x, y, x3, y3)
-        # Calculate area of triangle PAB
-        A3 = area(x1, y1, x2, y2, x, y)
-        # Check if sum of A1, A2 and A3
-        # is same as A (rounding to avoid inequalities caused by floating point arithmetic)
-        if round(A, 10) == round(A1 + A2 + A3, 10):
-            return True
-        else:
-            return False
-    
-    x1, y1, x2, y2, x3, y3 = coordinates_df[['Red', 'Green', 'Blue']].T.values.ravel()
-    total, inside_total = 0, 0
-    for _ in range(100000):
-        x, y = point_on_triangle(*colorspace._primaries)
-        inside_total += isInside(x1, y1, x2, y2, x3, y3, x, y)
-        total += 1
-    return inside_total / total
+def get_coverage(coordinates_df, colorspace, samples=None):
+    """
+    Share of the colorspace's chromaticity triangle covered by the measured primaries' triangle.
+    Computed exactly from the area of the triangles' intersection, or by sampling when samples is given.
+    """
+    primaries = coordinates_df[['Red', 'Green', 'Blue']].T.values.astype(float)
+    return gamut.triangle_coverage(primaries, colorspace.primaries, samples)
 
 @except_none_log
 def get_lum_df(paths):
     lum_df = pd.read_csv(paths['lum_profile'], header=None)
     height, width = lum_df.shape
-    lum_df.columns = map(lambda x: 100 * x / width, lum_df.columns)
-    lum_df.index = map(lambda x: 100 * (1 - x / height), lum_df.index)
+    lum_df.columns = 100 * np.arange(width) / width
+    lum_df.index = 100 * (1 - np.arange(height) / height)
     return lum_df
 
 @except_none_log
-def get_ccf_df(merged_df, data_folder):
-    ccf_df = pd.DataFrame(columns=['test_name', 'grey1', 'grey2', 'grey3', 'grey4', 'grey5'])
-    manual_ccf_tests = [test_name for test_name in merged_df.test_name.unique() if 'manual_ccf' in test_name]
+def get_ccf_df(test_store, data_folder):
+    cols = ['test_name', 'grey1', 'grey2', 'grey3', 'grey4', 'grey5']
+    manual_ccf_tests = [test_name for test_name in test_store.test_names if 'manual_ccf' in test_name]
+    rows = []
     for test_name in manual_ccf_tests:
-        tdf = merged_df.query('test_name==@test_name').copy()
+        tdf = test_store.test(test_name)
         row = {f'grey{i + 1}': tdf['nits'].iloc[i * 40 + 19:i * 40 + 24].mean() for i in range(len(tdf) // 40)}
         row['test_name'] = test_name
-        ccf_df = ccf_df.append(row, ignore_index=True)
+        rows.append(row)
+    ccf_df = pd.DataFrame(rows)
+    ccf_df = ccf_df.reindex(columns=cols + [col for col in ccf_df.columns if col not in cols])
     
     path = Path(data_folder).joinpath('ccf-summary.csv')
     ccf_df.to_csv(path, index=False)
@@ -625,7 +576,7 @@ def get_3bar_lum_df(paths):
 
 @except_none_log
 def get_dimming_line_df(rsdf, data_folder):
-    dimming_line_df = pd.DataFrame(columns=['pps', 'slope', 'intercept', 'r2'])
+    rows = []
     for pps in ['default', 'brightest', 'hdr']:
         pps_df = rsdf[rsdf['test_name'].str.contains(pps)]
         if len(pps_df) > 1:
@@ -633,77 +584,181 @@ def get_dimming_line_df(rsdf, data_folder):
             slope, intercept, r, _, _ = linregress(x, y)
             r2 = r ** 2
             row_data = {'pps': pps, 'slope': slope, 'intercept': intercept, 'r2': r2}
-            dimming_line_df = dimming_line_df.append(row_data, ignore_index=True)
+            rows.append(row_data)
+    dimming_line_df = pd.DataFrame(rows, columns=['pps', 'slope', 'intercept', 'r2'])
     dimming_line_df.to_csv(data_folder.joinpath('dimming-lines.csv'), index=False)
     return dimming_line_df
 
-def get_report_data(paths, data_folder, docopt_args):
-    data = {}
-    data['clean'] = docopt_args['-c']
-    data['data_folder'] = data_folder
-    data['report_type'] = get_report_type(docopt_args, data_folder)
-    data['omit_estar'] = docopt_args['--omit']
-    data['test_seq_df'] = get_test_seq_df(paths)
-    data['merged_df'] = get_merged_df(data['test_seq_df'], paths, data_folder)
-    data['hdr'] = get_hdr(data['merged_df'])
-    data['test_specs_df'] = get_test_specs_df(data['merged_df'], paths, data['report_type'], clean=data['clean'])
-    data['adjustment_factor'] = get_adjustment_factor(data['test_specs_df'])
-    data['estar_limit_funcs'] = get_limit_funcs('estar', data['adjustment_factor'])
-    data['va_limit_funcs'] = get_limit_funcs('alternative', data['adjustment_factor'])
-    # data['estar_limit_funcs'] = get_limit_funcs('estar', data['adjustment_factor'])
-    data['setup_img_paths'] = get_setup_img_paths(paths, data_folder)
-    data['bar3_lum_df'] = get_3bar_lum_df(paths)
-    if data['report_type']=='pcl':
-        data['persistence_dfs'] = get_persistence_dfs(paths)
-    if paths['spectral_profile'] is not None:
-        data['spectral_df'] = get_spectral_df(paths)
-        data['scdf'] = get_spectral_coordinates_df(paths)
-        data['bt2020_coverage'] = get_coverage(data['scdf'], BT2020_COLOURSPACE)
-        data['bt709_coverage'] = get_coverage(data['scdf'], BT709_COLOURSPACE)
-        data['washout_df'] = get_washout_df(paths)
-        data['washout_crossovers'] = get_washout_crossovers(data['washout_df'])
-        data['color_shift_df'] = get_color_shift_df(paths)
-        data['color_shift_crossovers'] = get_color_shift_crossovers(data['color_shift_df'])
-        data['brightness_loss_df'] = get_brightness_loss_df(paths)
-        data['brightness_loss_crossover'] = get_brightness_loss_crossover(data['brightness_loss_df'])
-        data['contrast_ratio'] = get_contrast_ratio(paths)
-        data['spectral_summary_df'] = get_spectral_summary_df(data)
-
+# threads used to build independent report data items at the same time
+REPORT_DATA_WORKERS = min(8, os.cpu_count() or 1)
+# seconds between checks for popups the worker threads need shown on the main thread
+MAIN_THREAD_POLL = .1
+SPECTRAL_SUMMARY_ITEMS = ['data_folder', 'bt2020_coverage', 'bt709_coverage', 'contrast_ratio', 'brightness_loss_crossover',
+                          'washout_crossovers', 'color_shift_crossovers']
+
+def get_report_data_graph(paths, data_folder, docopt_args):
+    """Map each report data item to the function that builds it and the items passed to that function."""
+    clean = docopt_args.get('-c', False)
+    graph = {
+        'clean': (lambda: clean, []),
+        'data_folder': (lambda: data_folder, []),
+        'report_type': (lambda: get_report_type(docopt_args, data_folder), []),
+        'omit_estar': (lambda: docopt_args.get('--omit', False), []),
+        'test_seq_df': (lambda: get_test_seq_df(paths), []),
+        'merged_df': (lambda test_seq_df: get_merged_df(test_seq_df, paths, data_folder,
+                                                        compact=docopt_args.get('--compact', False)),
+                      ['test_seq_df']),
+        'hdr': (get_hdr, ['merged_df']),
+        'test_specs_df': (lambda report_type: get_test_specs_df(paths, report_type, clean=clean), ['report_type']),
+        'adjustment_factor': (get_adjustment_factor, ['test_specs_df']),
+        'estar_limit_funcs': (partial(get_limit_funcs, 'estar'), ['adjustment_factor']),
+        'va_limit_funcs': (partial(get_limit_funcs, 'alternative'), ['adjustment_factor']),
+        'setup_img_paths': (lambda: get_setup_img_paths(paths, data_folder), []),
+        'bar3_lum_df': (lambda: get_3bar_lum_df(paths), []),
+        'persistence_dfs': (lambda report_type: get_persistence_dfs(paths) if report_type == 'pcl' else None,
+                            ['report_type']),
+        'waketimes': (get_waketimes, ['merged_df']),
+        'test_store': (get_test_store, ['merged_df']),
+        'rsdf': (get_results_summary_df, ['test_store', 'data_folder', 'waketimes']),
+        'test_date': (get_test_date, ['test_specs_df']),
+        'area': (get_screen_area, ['test_specs_df']),
+        'model': (lambda test_specs_df: get_model(test_specs_df, clean=clean), ['test_specs_df']),
+        'estar_on_mode_df': (lambda rsdf, limit_funcs, area, hdr: get_on_mode_df(rsdf, limit_funcs, area, 'estar', hdr),
+                             ['rsdf', 'estar_limit_funcs', 'area', 'hdr']),
+        'va_on_mode_df': (lambda rsdf, limit_funcs, area, hdr: get_on_mode_df(rsdf, limit_funcs, area, 'alternative', hdr),
+                          ['rsdf', 'va_limit_funcs', 'area', 'hdr']),
+        'standby_df': (get_standby_df, ['rsdf']),
+        'status_df': (lambda test_seq_df, merged_df, data_folder: get_status_df(test_seq_df, merged_df, paths, data_folder),
+                      ['test_seq_df', 'merged_df', 'data_folder']),
+        'lum_df': (lambda: get_lum_df(paths), []),
+        'dimming_line_df': (get_dimming_line_df, ['rsdf', 'data_folder']),
+    }
+    if paths.get('spectral_profile') is not None:
+        graph.update({
+            'spectral_profile': (lambda: get_spectral_profile(paths), []),
+            'spectral_df': (get_spectral_df, ['spectral_profile']),
+            'scdf': (get_spectral_coordinates_df, ['spectral_profile']),
+            'bt2020_coverage': (lambda scdf: get_coverage(scdf, BT2020_COLOURSPACE), ['scdf']),
+            'bt709_coverage': (lambda scdf: get_coverage(scdf, BT709_COLOURSPACE), ['scdf']),
+            'washout_df': (get_washout_df, ['spectral_profile']),
+            'washout_crossovers': (get_washout_crossovers, ['washout_df']),
+            'color_shift_df': (get_color_shift_df, ['spectral_profile']),
+            'color_shift_crossovers': (get_color_shift_crossovers, ['color_shift_df']),
+            'brightness_loss_df': (get_brightness_loss_df, ['spectral_profile']),
+            'brightness_loss_crossover': (get_brightness_loss_crossover, ['brightness_loss_df']),
+            'contrast_ratio': (lambda: get_contrast_ratio(paths), []),
+            'spectral_summary_df': (lambda *args: get_spectral_summary_df(dict(zip(SPECTRAL_SUMMARY_ITEMS, args))),
+                                    SPECTRAL_SUMMARY_ITEMS),
+        })
     else:
-        data['persistence_dfs'] = None
-        data['spectral_df'] = None
-        data['scdf'] = None
-        data['washout_df'] = None
-        data['washout_crossovers'] = None
-        data['color_shift_df'] = None
-        data['color_shift_crossovers'] = None
-        data['brightness_loss_df'] = None
-        data['brightness_loss_crossover'] = None
-    data['waketimes'] = get_waketimes(data['merged_df'])
-    data['rsdf'] = get_results_summary_df(data['merged_df'], data_folder, data['waketimes'])
-    
-    data['test_date'] = get_test_date(data['test_specs_df'])
-    data['area'] = get_screen_area(data['test_specs_df'])
-    data['model'] = get_model(data['test_specs_df'], clean=data['clean'])
-    data['estar_on_mode_df'] = get_on_mode_df(data['rsdf'], data['estar_limit_funcs'], data['area'], 'estar', data['hdr'])
-    data['va_on_mode_df'] = get_on_mode_df(data['rsdf'], data['va_limit_funcs'], data['area'], 'alternative', data['hdr'])
-    # data['estar_on_mode_df'] = get_on_mode_df(data['rsdf'], data['limit_funcs'], data['area'], 'estar', data['hdr'])
-    data['standby_df'] = get_standby_df(data['rsdf'])
-    data['status_df'] = get_status_df(data['test_seq_df'], data['merged_df'], paths, data['data_folder'])
-    data['lum_df'] = get_lum_df(paths)
-    get_dimming_line_df(data['rsdf'], data_folder)
-    # data['csdf'] = get_compliance_summary_df(data['on_mode_df'], data['standby_df'], data['report_type'], data['hdr'])
-    
-    
-    return data
+        spectral_items = ['spectral_profile', 'spectral_df', 'scdf', 'washout_df', 'washout_crossovers', 'color_shift_df',
+                          'color_shift_crossovers', 'brightness_loss_df', 'brightness_loss_crossover']
+        graph.update({item: (lambda: None, []) for item in spectral_items})
+    return graph
+
+
+class ReportData(Mapping):
+    """
+    Report data items, each computed from the items it depends on the first time it is accessed.
+
+    Only items that have been computed (or set) are listed, so passing **report_data to the report
+    section functions passes exactly the items asked for through compute or item access.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.values = {}
+
+    def __getitem__(self, item):
+        if item not in self.values:
+            if item not in self.graph:
+                raise KeyError(item)
+            func, deps = self.graph[item]
+            self.values[item] = func(*[self[dep] for dep in deps])
+        return self.values[item]
+
+    def __setitem__(self, item, value):
+        self.values[item] = value
+
+    def __contains__(self, item):
+        return item in self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def compute(self, items=None, workers=1):
+        """
+        Compute items (every item in the graph by default), skipping items the graph can't build.
+        With several workers, items whose dependencies are ready are built concurrently in a thread pool.
+        """
+        items = [item for item in (self.graph if items is None else items) if item in self.graph]
+        if workers > 1:
+            self.compute_concurrently(items, workers)
+        for item in items:
+            self[item]
+        return self
+
+    def compute_concurrently(self, items, workers):
+        """Compute items and their dependencies in a thread pool, storing results in graph order."""
+        needed, stack = set(), list(items)
+        while stack:
+            item = stack.pop()
+            if item not in self.values and item not in needed:
+                needed.add(item)
+                stack.extend(self.graph[item][1])
+
+        results, running = {}, {}
+        def submit_ready(executor):
+            for item in [item for item in self.graph if item in needed]:
+                func, deps = self.graph[item]
+                if all(dep in self.values or dep in results for dep in deps):
+                    args = [self.values[dep] if dep in self.values else results[dep] for dep in deps]
+                    running[executor.submit(func, *args)] = item
+                    needed.remove(item)
+
+        error = None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            submit_ready(executor)
+            while running:
+                # permission popups raised in the workers are shown from here, so after an error the running
+                # items are still waited for here rather than in the executor's shutdown
+                done, _ = wait(running, timeout=MAIN_THREAD_POLL, return_when=FIRST_COMPLETED)
+                run_main_thread_calls()
+                for future in done:
+                    item = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                    else:
+                        results[item] = future.result()
+                if error is None:
+                    submit_ready(executor)
+        if error is not None:
+            raise error
+        for item in self.graph:
+            if item in results:
+                self.values[item] = results[item]
+
+
+def get_report_data(paths, data_folder, docopt_args, expected_data=None, workers=REPORT_DATA_WORKERS):
+    """
+    Build the report data items in expected_data and the items they depend on (all items by default),
+    running independent items concurrently. Other items are computed when they are first accessed.
+    """
+    report_data = ReportData(get_report_data_graph(paths, data_folder, docopt_args))
+    return report_data.compute(expected_data, workers=workers)
 
 
 def check_report_data(report_data, expected_data):
     data_items = {
         'report_type': 'report type',
         'merged_df': 'merged time series data (merged.csv)',
+        'test_store': 'per test time series data',
         'hdr': 'hdr capability',
-        'limit_funcs': 'power limit equations',
+        'estar_limit_funcs': 'ENERGYSTAR power limit equations',
+        'va_limit_funcs': 'alternative power limit equations',
         'persistence_dfs': 'ABC/MDD persistence tables',
         'spectral_df': 'spectral distribution data',
         'waketimes': 'standby waketimes',
@@ -712,7 +767,8 @@ def check_report_data(report_data, expected_data):
         'test_date': 'date of testing',
         'area': 'screen area',
         'model': 'television model number',
-        'on_mode_df': 'on mode compliance table',
+        'estar_on_mode_df': 'ENERGYSTAR on mode compliance table',
+        'va_on_mode_df': 'alternative on mode compliance table',
         'standby_df': 'standby compliance table',
         'lum_df': 'luminance profile'
     }
@@ -284,11 +284,16 @@ def make_img_from_plot(plot, **kwargs):
     return make_img(imgdata, **kwargs)
 
 
+def make_img_from_png(png, **kwargs):
+    """Return an Image object from PNG bytes (see core.report.render)."""
+    return make_img(io.BytesIO(png), **kwargs)
+
 
 def flowable_factory(content, **kw):
     """Return appropriate flowable object from given content type"""
     factory = {
         type(gcf()): make_img_from_plot,
+        bytes: make_img_from_png,
         str: make_paragraph,
         pd.core.frame.DataFrame: make_table,
         type(Path()): make_img
@@ -354,6 +359,7 @@ class Section(Node):
             save_path = Path(self.save_content_dir).joinpath(f"{name.replace(' ', '_').replace(':','')}")
             f = {
                 type(gcf()): f'content.savefig(r"{save_path}.png")',
+                bytes: f'Path(r"{save_path}.png").write_bytes(content)',
                 type(pd.DataFrame()): f'content.to_csv(r"{save_path}.csv", index=False)'
             }
             eval(f.get(type(content), 'None'))
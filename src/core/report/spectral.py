@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+from colour import XYZ_to_Lab, Lab_to_LCHab
+
+
+class SpectralProfile:
+    """
+    Viewing angle spectral profile (the *viewing*.csv file), parsed once and shared by all spectral analyses.
+
+    Each column holds one color measured at one viewing angle and is named '<color>(<angle>)'.
+    Rows 12-14 hold the XYZ values, rows 18-19 the xy chromaticity coordinates and rows 39 onwards
+    the spectral power distribution.
+    """
+
+    def __init__(self, path):
+        df = pd.read_csv(path)
+        df = df.set_index(df.columns[0])
+        df.index.name = ''
+        self.df = df
+
+        self.colors = np.array([col.split('(')[0].strip() for col in df.columns])
+        self.angles = np.array([int(col.split('(')[1].replace(')', '')) for col in df.columns])
+        self.XYZ = df.iloc[12:15].values.astype(float).T
+        # XYZ relative to the first column (white at 0 degrees)
+        self.norm_XYZ = np.minimum(self.XYZ / self.XYZ[0], 1)
+        # colour converts the whole (columns, 3) array at once
+        self.LCHab = Lab_to_LCHab(XYZ_to_Lab(self.norm_XYZ))
+
+    @property
+    def spectral_df(self):
+        """Spectral power distribution of the first four columns, indexed by wavelength."""
+        df = self.df.iloc[39:, :4].astype(float)
+        df.index = df.index.astype(float)
+        df.index.name = 'Wavelength (nm)'
+        df.columns = self.colors[:4]
+        return df
+
+    @property
+    def coordinates_df(self):
+        """xy chromaticity coordinates of the red, green and blue primaries at 0 degrees."""
+        df = self.df.iloc[18:20][['Red(0)', 'Green(0)', 'Blue(0)']].astype(float)
+        df.columns = ['Red', 'Green', 'Blue']
+        return df.reset_index()
+
+    def grid(self, values):
+        """
+        Arrange one value per column into an (angles, colors) array.
+        Returns the sorted angles, the sorted colors and the array (NaN where a color wasn't measured at an angle).
+        """
+        angles, angle_idx = np.unique(self.angles, return_inverse=True)
+        colors, color_idx = np.unique(self.colors, return_inverse=True)
+        grid = np.full((len(angles), len(colors)), np.nan)
+        grid[angle_idx, color_idx] = values
+        return angles, colors, grid
+
+    def pivot(self, values):
+        """Arrange one value per column into a frame indexed by angle with one column per color."""
+        angles, colors, grid = self.grid(values)
+        return pd.DataFrame(grid, index=pd.Index(angles, name='angle'), columns=list(colors))
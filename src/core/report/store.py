@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+
+
+def row_ranges(values):
+    """
+    Return {value: (start, stop)} for the runs of a sorted array (null values are skipped).
+    Returns None if any value is split over several runs.
+    """
+    codes, uniques = pd.factorize(values)
+    starts = np.flatnonzero(np.diff(codes, prepend=-2))
+    stops = np.append(starts[1:], len(codes))
+    run_codes = codes[starts]
+    valid = run_codes >= 0
+    if len(np.unique(run_codes[valid])) != valid.sum():
+        return None
+    return {uniques[code]: (start, stop) for code, start, stop in zip(run_codes[valid], starts[valid], stops[valid])}
+
+
+class TestDataStore:
+    """
+    merged_df rows grouped by test, built once so that each test can be sliced out without scanning merged_df.
+
+    Rows are stably sorted by tag (keeping time order within each test) and the row range of every tag and
+    test_name is indexed, so test() returns a slice of the sorted frame and aggregate() reduces over tag segments.
+    """
+
+    def __init__(self, merged_df):
+        order = np.argsort(merged_df['tag'].values, kind='mergesort')
+        self.df = merged_df.iloc[order].reset_index(drop=True)
+        self.tag_ranges = row_ranges(self.df['tag'].values)
+        self.test_ranges = row_ranges(self.df['test_name'].values)
+
+    @property
+    def test_names(self):
+        """Test names in tag order."""
+        if self.test_ranges is None:
+            return list(self.df['test_name'].dropna().unique())
+        return list(self.test_ranges)
+
+    def segments(self):
+        """Tags in ascending order with the first and last + 1 row of each."""
+        tags = np.array(list(self.tag_ranges), dtype=float)
+        bounds = np.array(list(self.tag_ranges.values()), dtype=int).reshape(-1, 2)
+        return tags, bounds[:, 0], bounds[:, 1]
+
+    def aggregate(self, stats, tail=None):
+        """
+        Per tag statistics computed with one reduction per statistic over the tag sorted rows.
+
+        stats maps each output column to a (column, statistic) pair, where statistic is one of 'first'
+        (first non-null value), 'count', 'sum', 'mean', 'min', 'max', 'std' or 'tail_mean' (mean of the
+        last tail rows of the tag). Null values are skipped like in a pandas groupby. The null mask and the
+        prefix sums of each column are computed once and shared by its statistics.
+        Returns a frame indexed by tag with one column per stats item.
+        """
+        tags, starts, stops = self.segments()
+        index = pd.Index(tags, name='tag')
+        if not len(tags):
+            return pd.DataFrame(index=index, columns=list(stats))
+        # rows without a tag are sorted after the last tag's rows, reduceat would count them in the last segment
+        end = stops[-1]
+        notna = {col: self.df[col].notna().values[:end] for col, _ in stats.values()}
+        numeric = {col for col, stat in stats.values() if stat != 'first'}
+        values = {col: np.where(notna[col], self.df[col].values[:end].astype(float), 0) for col in numeric}
+        totals = {col: np.concatenate([[0], np.cumsum(values[col])]) for col in numeric}
+        counts = {col: np.concatenate([[0], np.cumsum(notna[col])]) for col in numeric}
+
+        data = {}
+        for name, (col, stat) in stats.items():
+            if stat == 'first':
+                series = self.df[col]
+                positions = np.where(notna[col], np.arange(end), end)
+                first = np.minimum.reduceat(positions, starts)
+                valid = first < stops
+                data[name] = series.take(np.where(valid, first, 0)).where(valid).values
+                continue
+
+            window_starts = np.maximum(starts, stops - tail) if stat == 'tail_mean' else starts
+            total = totals[col][stops] - totals[col][window_starts]
+            count = counts[col][stops] - counts[col][window_starts]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                if stat == 'count':
+                    data[name] = count
+                elif stat == 'sum':
+                    data[name] = total
+                elif stat in ('mean', 'tail_mean'):
+                    data[name] = total / count
+                elif stat == 'std':
+                    deviations = np.where(notna[col], values[col] - np.repeat(total / count, stops - starts), 0)
+                    data[name] = np.sqrt(np.add.reduceat(deviations ** 2, starts) / (count - 1))
+                elif stat in ('min', 'max'):
+                    ufunc = np.fmin if stat == 'min' else np.fmax
+                    data[name] = ufunc.reduceat(np.where(notna[col], values[col], np.nan), starts)
+                else:
+                    raise ValueError(f'unknown statistic: {stat}')
+        return pd.DataFrame(data, index=index, columns=list(stats))
+
+    def test(self, test_name):
+        """Rows of a single test."""
+        if self.test_ranges is None:
+            # a test_name spread over several tags can't be sliced
+            return self.df[self.df['test_name'] == test_name]
+        start, stop = self.test_ranges.get(test_name, (0, 0))
+        return self.df.iloc[start:stop]
+
+    def subset(self, test_names):
+        """A TestDataStore of the given tests only (e.g. so a figure's cache key only covers the tests it draws)."""
+        return TestDataStore(pd.concat([self.df.iloc[:0]] + [self.test(test_name) for test_name in test_names]))
@@ -11,6 +11,7 @@ Options:
 """
 from pathlib import Path
 from core.report.report_data import get_report_data, check_report_data
+from core.report.render import use_figure_cache
 from report import add_light_directionality, ISection, build_report, add_test_specs
 import core.logfuncs as lf
 import core.filefuncs as ff
@@ -37,13 +38,16 @@ def main():
     else:
         paths = ff.get_paths(data_folder)
 
-    report_data = get_report_data(paths, data_folder, docopt_args)
-    report_data['data_folder'] = paths['lum_profile'].parent
     expected_data = [
         'lum_df',
-        'test_specs_df'
+        'test_specs_df',
+        'model',
+        'test_date'
     ]
+    report_data = get_report_data(paths, data_folder, docopt_args, expected_data)
+    report_data['data_folder'] = paths['lum_profile'].parent
     check_report_data(report_data, expected_data)
+    use_figure_cache(report_data['data_folder'])
     make_lum_report(report_data)
 
 
@@ -8,6 +8,7 @@ Arguments:
 Options:
   -h --help
 """
+import pandas as pd
 import core.logfuncs as lf
 import core.filefuncs as ff
 from core.report.report_data import get_merged_df
@@ -15,7 +16,8 @@ from core.report.report_data import get_merged_df
 def main():
     logger, docopt_args, data_folder = lf.start_script(__doc__, 'merge_results.log')
     paths = ff.get_paths(data_folder)
-    get_merged_df(paths, data_folder)
+    test_seq_df = pd.read_csv(paths['test_seq'])
+    get_merged_df(test_seq_df, paths, data_folder)
 
 
 if __name__ == '__main__':
@@ -10,6 +10,7 @@ Options:
   -h --help
 """
 from core.report.report_data import get_report_data, check_report_data
+from core.report.render import use_figure_cache
 from report import add_overlay, ISection, build_report, add_test_specs
 import core.logfuncs as lf
 import core.filefuncs as ff
@@ -30,13 +31,17 @@ def main():
     logger, docopt_args, data_folder = lf.start_script(__doc__, 'lum_report.log')
     test_names = [docopt_args['<test_name1>'], docopt_args['<test_name2>']]
     paths = ff.get_paths(data_folder)
-    report_data = get_report_data(paths, data_folder, docopt_args)
     expected_data = [
+        'data_folder',
         'rsdf',
-        'merged_df'
-        'test_specs_df'
+        'test_store',
+        'test_specs_df',
+        'model',
+        'test_date'
     ]
+    report_data = get_report_data(paths, data_folder, docopt_args, expected_data)
     check_report_data(report_data, expected_data)
+    use_figure_cache(data_folder)
     make_overlay_report(report_data, test_names)
     
     
@@ -11,8 +11,10 @@ Options:
   -p            force PCL report type
   --omit        omit ENERGYSTAR compliance section
   -c            cleanse report of model name
+  --compact     keep merged data in a compact form (for very long tests)
 """
 import sys
+import multiprocessing
 from pathlib import Path
 import numpy as np
 import pandas as pd
@@ -20,6 +22,7 @@ from reportlab.lib.units import inch
 from reportlab.platypus import PageBreak
 import core.report.reportlab_sections as rls
 import core.report.plots as plots
+from core.report.render import render, render_pngs, use_figure_cache
 import core.report.report_data as rd
 
 import core.logfuncs as lf
@@ -316,7 +319,7 @@ def add_persistence_summary(report, persistence_dfs, **kwargs):
     return report
 
 @skip_and_warn
-def add_compliance_section(report, merged_df, report_type, omit_estar, estar_on_mode_df, va_on_mode_df,
+def add_compliance_section(report, test_store, report_type, omit_estar, estar_on_mode_df, va_on_mode_df,
                            estar_limit_funcs, va_limit_funcs, hdr, rsdf, area, standby_df,
                            waketimes, adjustment_factor, **kwargs):
 
@@ -345,7 +348,8 @@ def add_compliance_section(report, merged_df, report_type, omit_estar, estar_on_
                 def add_standby_chart(report):
                     standby_tests = [test for test in rsdf.test_name.unique() if 'standby' in test]
                     # time vs power (line) plot showing all standby tests
-                    standby_chart.create_element('standby_plot', plots.standby(merged_df, standby_tests))
+                    standby_plot = render(plots.standby, test_store.subset(standby_tests), standby_tests)
+                    standby_chart.create_element('standby_plot', standby_plot)
     
                 add_standby_chart(report)
         @skip_and_warn
@@ -439,7 +443,7 @@ def add_compliance_section(report, merged_df, report_type, omit_estar, estar_on_
             if hdr: pps_list += ['hdr10']
             section.create_element(
                 f'Dimming plots',
-                plots.stacked_dimming_line_scatter(pps_list, rsdf, area, limit_funcs)
+                render(plots.stacked_dimming_line_scatter, pps_list, rsdf, area, limit_funcs)
             )
             # for pps in ['default', 'brightest']:
             #     section.create_element(
@@ -465,13 +469,24 @@ def add_compliance_section(report, merged_df, report_type, omit_estar, estar_on_
         #             add_on_mode_charts(report, estar_on_mode_charts, estar_limit_funcs)
             
         with cat.new_section('All On Mode Tests Chart') as all_tests_chart:
-            all_tests_chart.create_element('all dimming lines plot', plots.all_dimming_lines(rsdf))
+            all_tests_chart.create_element('all dimming lines plot', render(plots.all_dimming_lines, rsdf))
             
 
     return report
 
+def render_apl_power_plots(test_store, test_names):
+    """
+    Render the APL' vs power scatter of each test in worker processes, returning {test_name: PNG bytes}
+    (None for tests whose figure failed).
+    """
+    # each worker only receives the rows of its own test
+    jobs = [(plots.apl_watts_scatter, (test_store.subset([test_name]), test_name))
+            for test_name in test_names]
+    return dict(zip(test_names, render_pngs(jobs)))
+
+
 @skip_and_warn
-def add_apl_power(report, test_name, merged_df, rsdf, section_name=None, **kwargs):
+def add_apl_power(report, test_name, test_store, rsdf, section_name=None, plot=None, **kwargs):
     table_df = rsdf.query('test_name==@test_name')
     if not section_name:
         tag = table_df.index[0]
@@ -479,43 +494,46 @@ def add_apl_power(report, test_name, merged_df, rsdf, section_name=None, **kwarg
             tag = int(tag)
         section_name = f'Test {tag} - {test_name}'
 
+    if plot is None:
+        # drawn here when it wasn't rendered up front (or failed to render), an error skips this test only
+        plot = render(plots.apl_watts_scatter, test_store.subset([test_name]), test_name)
     with report.new_section(section_name) as section:
         table_df = clean_rsdf(table_df)
         section.create_element('table', table_df, save=False)
-        section.create_element(f'{section_name}plot', plots.apl_watts_scatter(merged_df, test_name))
+        section.create_element(f'{section_name}plot', plot)
     return report
 
 @skip_and_warn
 def add_light_directionality(report, lum_df, **kwargs):
     with report.new_section("Average Luminance Along TV's Horizontal Axis", numbering=False) as x_nits:
-        x_nits.create_element('x nits plot', plots.x_nits(lum_df))
+        x_nits.create_element('x nits plot', render(plots.x_nits, lum_df))
     with report.new_section("Average Luminance Along TV's Vertical Axis", numbering=False) as y_nits:
-        y_nits.create_element('y nits plot', plots.y_nits(lum_df))
+        y_nits.create_element('y nits plot', render(plots.y_nits, lum_df))
     with report.new_section('Luminance Heatmap', numbering=False) as heatmap:
-        heatmap.create_element('heatmap', plots.nits_heatmap(lum_df))
+        heatmap.create_element('heatmap', render(plots.nits_heatmap, lum_df))
     return report
 
 @skip_and_warn
-def add_overlay(report, rsdf, merged_df, test_names, **kwargs):
+def add_overlay(report, rsdf, test_store, test_names, **kwargs):
     # table and line plot showing stabilization tests
     table_df = clean_rsdf(rsdf.query('test_name.isin(@test_names)'))
     report.create_element('table', table_df)
-    report.create_element('plot', plots.overlay(merged_df, test_names))
+    report.create_element('plot', render(plots.overlay, test_store.subset(test_names), test_names))
 
 @skip_and_warn
-def add_supplemental(report, rsdf, merged_df, hdr, lum_df, spectral_df, scdf, washout_df, washout_crossovers,
+def add_supplemental(report, rsdf, test_store, hdr, lum_df, spectral_df, scdf, washout_df, washout_crossovers,
                      color_shift_df, color_shift_crossovers, brightness_loss_df, brightness_loss_crossover, **kwargs):
     with report.new_section('Supplemental Test Results', page_break=False) as supp:
         with supp.new_section('Stabilization') as stab:
             stab_tests = [test for test in rsdf.test_name.unique() if 'stabilization' in test]
-            stab = add_overlay(stab, rsdf, merged_df, stab_tests)
+            stab = add_overlay(stab, rsdf, test_store, stab_tests)
         
         with supp.new_section("APL' vs Power Charts", page_break=False)as apl_power:
             # APL vs power scatter plots for each pps (w/ line of best fit)
-            apl_power = add_apl_power(apl_power, 'default', merged_df, rsdf, section_name='Default PPS: SDR')
-            apl_power = add_apl_power(apl_power, 'brightest', merged_df, rsdf, section_name='Brightest PPS: SDR')
+            apl_power = add_apl_power(apl_power, 'default', test_store, rsdf, section_name='Default PPS: SDR')
+            apl_power = add_apl_power(apl_power, 'brightest', test_store, rsdf, section_name='Brightest PPS: SDR')
             if hdr:
-                apl_power = add_apl_power(apl_power, 'hdr10', merged_df, rsdf, section_name='Default PPS: HDR')
+                apl_power = add_apl_power(apl_power, 'hdr10', test_store, rsdf, section_name='Default PPS: HDR')
         with supp.new_section('Light Directionality', page_break=False) as ld:
             ld = add_light_directionality(ld, lum_df)
         
@@ -523,9 +541,9 @@ def add_supplemental(report, rsdf, merged_df, hdr, lum_df, spectral_df, scdf, wa
             @skip_and_warn
             def add_spectral_power_distribution(report):
                 with supp.new_section('Spectral Power Distribution') as spd:
-                    spd.create_element('spectral plot', plots.spectral_power_distribution(spectral_df))
+                    spd.create_element('spectral plot', render(plots.spectral_power_distribution, spectral_df))
                     spd.create_element('cheap page break', '<br /><br /><br /><br /><br /><br /><br /><br /><br /><br />')
-                    spd.create_element('chromaticity plot', plots.chromaticity(spectral_df))
+                    spd.create_element('chromaticity plot', render(plots.chromaticity, spectral_df))
                     spd.create_element('spectral coordinates table', scdf)
                     text = f" BT.2020 Colorspace Coverage: {100*kwargs['bt2020_coverage']:.0f}%<br /> BT.709 Colorspace Coverage: {100*kwargs['bt709_coverage']:.0f}%"
                     spd.create_element('coverage', text)
@@ -533,14 +551,14 @@ def add_supplemental(report, rsdf, merged_df, hdr, lum_df, spectral_df, scdf, wa
             @skip_and_warn
             def add_viewing_angle(report):
                 with supp.new_section('Viewing Angle Tests') as vat:
-                    vat.create_element('color washout plot', plots.color_washout(washout_df))
+                    vat.create_element('color washout plot', render(plots.color_washout, washout_df))
                     text = '80% Crossovers:<br/><br/>'
                     for color, crossover in washout_crossovers.items():
                         if crossover is not None:
                             text += f'{color}: {round(crossover, 1)}<br/>'
                     vat.create_element('washout crossovers', text)
                     
-                    vat.create_element('color shift plot', plots.color_shift(color_shift_df))
+                    vat.create_element('color shift plot', render(plots.color_shift, color_shift_df))
                     text = ''
                     if any(color_shift_crossovers['positive'].values()):
                         text = '3° Crossovers: <br/>'
@@ -555,7 +573,7 @@ def add_supplemental(report, rsdf, merged_df, hdr, lum_df, spectral_df, scdf, wa
                     if text:
                         vat.create_element('color shift crossovers', text)
                     vat.elements['color shift page break'] = [PageBreak()]
-                    vat.create_element('brightness loss plot', plots.brightness_loss(brightness_loss_df))
+                    vat.create_element('brightness loss plot', render(plots.brightness_loss, brightness_loss_df))
                     text = f'75% Crossover: {round(brightness_loss_crossover, 1)}'
                     vat.create_element('brightness loss crossover', text)
             add_viewing_angle(report)
@@ -569,18 +587,23 @@ def add_test_results_table(report, rsdf, **kwargs):
     return report
 
 @skip_and_warn
-def add_test_results_plots(report, rsdf, merged_df, **kwargs):
+def add_test_results_plots(report, rsdf, test_store, **kwargs):
     '''Test Specifics section displays test metadata and tv specs in table'''
+    test_names = list(rsdf['test_name'])
+    tdfs = [test_store.test(test_name).reset_index() for test_name in test_names]
+    # the four panel figures are independent, draw them in parallel and insert the PNGs
+    pngs = render_pngs([(plots.standard, (tdf,)) for tdf in tdfs])
     with report.new_section('Plots of All Tests', page_break=False) as trp:
-        for test_name in rsdf['test_name']:
-            tdf = merged_df.query('test_name==@test_name').reset_index()
+        for test_name, tdf, png in zip(test_names, tdfs, pngs):
+            if png is None:
+                png = render(plots.standard, tdf)
             tag = tdf.iloc[0]['tag']
             if tag.is_integer():
                 tag = int(tag)
             with trp.new_section(f'Test {tag} - {test_name}', numbering=False) as tn:
                 table_df = clean_rsdf(rsdf.query('test_name==@test_name'))
                 tn.create_element(f'{test_name} table', table_df, save=False)
-                tn.create_element(f'{test_name} plot', plots.standard(tdf))
+                tn.create_element(f'{test_name} plot', png)
     return report
 
 @skip_and_warn
@@ -673,14 +696,18 @@ def main():
     paths = ff.get_paths(data_folder)
     
     if Path(sys.path[0]).joinpath('simple.txt').exists():
-        merged_df = rd.get_merged_df(paths, data_folder)
-        rd.get_results_summary_df(merged_df, data_folder, waketimes={})
-        rd.get_ccf_df(merged_df, data_folder)
+        merged_df = rd.get_merged_df(rd.get_test_seq_df(paths), paths, data_folder,
+                                     compact=docopt_args['--compact'])
+        test_store = rd.get_test_store(merged_df)
+        rd.get_results_summary_df(test_store, data_folder, waketimes={})
+        rd.get_ccf_df(test_store, data_folder)
     else:
         report_data = rd.get_report_data(paths, data_folder, docopt_args)
         ISection.save_content_dir = Path(data_folder).joinpath('Elements')
+        use_figure_cache(data_folder)
         make_report(report_data)
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main()
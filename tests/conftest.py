@@ -0,0 +1,16 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import types
+from pathlib import Path
+
+# the scripts import the core package from src (see setup.py)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath('src')))
+# core.filefuncs keeps its appdata folder under LOCALAPPDATA (always set on Windows)
+os.environ.setdefault('LOCALAPPDATA', tempfile.mkdtemp())
+
+# the GUI toolkit isn't a requirement of the report code, popups are answered with OK when it isn't installed
+if importlib.util.find_spec('PySimpleGUI') is None:
+    sys.modules['PySimpleGUI'] = types.ModuleType('PySimpleGUI')
+    sys.modules['PySimpleGUI'].Popup = lambda *args, **kwargs: 'OK'
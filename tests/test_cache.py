@@ -0,0 +1,63 @@
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from core.report import cache
+
+
+def make_limit_func(factor):
+    def power_limit(area, luminance, a=1):
+        return factor * a * area * np.asarray(luminance)
+    return partial(power_limit, a=2)
+
+
+def test_closures_hashed_by_captured_values():
+    assert cache.hash_objects(make_limit_func(1)) == cache.hash_objects(make_limit_func(1))
+    assert cache.hash_objects(make_limit_func(1)) != cache.hash_objects(make_limit_func(.75))
+
+
+def test_functions_hashed_by_code_and_defaults():
+    def scale(x, factor=2):
+        return x * factor
+
+    def scale_changed(x, factor=2):
+        return x * factor + 1
+
+    def scale_default(x, factor=3):
+        return x * factor
+
+    scale_changed.__qualname__ = scale_default.__qualname__ = scale.__qualname__
+    keys = {cache.hash_objects(func) for func in [scale, scale_changed, scale_default]}
+    assert len(keys) == 3
+
+
+def test_recursive_closure():
+    def countdown(n):
+        return n if n <= 0 else countdown(n - 1)
+    assert cache.hash_objects(countdown) == cache.hash_objects(countdown)
+
+
+def test_frame_round_trip(tmp_path):
+    df = pd.DataFrame({
+        'tag': [1.0, 2.0, 3.0],
+        'test_name': ['a', np.nan, 'b'],
+        'lux': pd.Series([10, 'auto', 3.5], dtype=object),
+        'abc': [True, False, True],
+        'video': pd.Categorical(['x', 'y', 'x']),
+        'time': pd.to_datetime(['2020-05-01 12:00:00', '2020-05-01 12:00:01', '2020-05-01 12:00:02']),
+    })
+    path = tmp_path.joinpath('frame.npz')
+    cache.save_frame(df, path, 'key', meta={'offset': 10})
+    loaded = cache.load_frame(path, 'key')
+    assert loaded['lux'].tolist() == [10, 'auto', 3.5]
+    pd.testing.assert_frame_equal(loaded.astype({'video': 'category'}), df, check_dtype=False)
+    assert cache.load_frame(path, 'other key') is None
+    assert cache.load_meta(path) == {'offset': 10}
+
+
+def test_pickled_archive_not_loaded(tmp_path):
+    path = tmp_path.joinpath('frame.npz')
+    np.savez(path, key=np.array('key'), meta=np.array('null'), columns=np.array(['x']),
+             column0=np.array([{'a': 1}], dtype=object), index=np.arange(1))
+    assert cache.load_frame(path, 'key') is None
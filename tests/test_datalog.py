@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from core.report import datalog, merge
+
+
+@pytest.fixture(autouse=True)
+def no_apl_tables(monkeypatch):
+    monkeypatch.setattr(merge, 'load_apl_tables', lambda: {})
+
+
+def make_test_seq():
+    return pd.DataFrame({
+        'tag': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+        'test_name': ['default', 'standby', 'waketime', 'stabilization', 'camera', 'brightest'],
+        'test_time': [5, 4, 3, 10, 6, 4],
+        'video': ['ire', np.nan, np.nan, 'ire', 'ire', 'ire'],
+    })
+
+
+def make_datalog():
+    """Raw datalog rows with stabilization, user command, camera ccf and null tags, a rewind and a repeated second."""
+    tags = (['1'] * 9 + [np.nan] * 2 + ['2'] * 7 + ['3'] * 2 + ['3.1 - user command'] * 4 + ['3'] * 3
+            + ['4 - stabilization 1'] * 6 + ['4 - stabilization 2'] * 5 + ['5 - camera ccf 1'] * 4
+            + ['5 - camera ccf 2'] * 4 + ['6'] * 5 + ['5 - camera ccf 1'] * 6 + ['6'] * 9)
+    rng = np.random.RandomState(1)
+    steps = rng.choice([0, .3, .5, 1, 1.2], len(tags))
+    return pd.DataFrame({
+        'Timestamp': pd.Timestamp('2020-05-01 12:00:00') + pd.to_timedelta(np.cumsum(steps), unit='s'),
+        'Power': rng.rand(len(tags)).round(3) * 100,
+        'Luminance': rng.rand(len(tags)).round(3) * 300,
+        'Tag': pd.Series(tags, dtype=object),
+    })
+
+
+def merge_whole(test_seq_df, datalog_path):
+    merged_df = merge.merge_test_data(test_seq_df, pd.read_csv(datalog_path, parse_dates=['Timestamp'],
+                                                               encoding='utf-8-sig'))
+    merged_df['source'] = datalog_path.name
+    return merged_df.reset_index(drop=True)
+
+
+def complete_lines(text, cut):
+    return text[:text.rindex(b'\n', 0, cut) + 1] if b'\n' in text[:cut] else text[:cut]
+
+
+@pytest.mark.parametrize('bom', [False, True])
+def test_growing_datalog_matches_whole_merge(tmp_path, bom):
+    test_seq_df = make_test_seq()
+    text = make_datalog().to_csv(index=False).encode()
+    prefix = b'\xef\xbb\xbf' if bom else b''
+    datalog_path = tmp_path.joinpath('x-datalog.csv')
+    merged_path = tmp_path.joinpath('merged.csv')
+    whole_path = tmp_path.joinpath('whole-datalog.csv')
+
+    # the datalog grows between merges, often with a partially written last line
+    header_end = text.index(b'\n') + 1
+    for cut in list(range(header_end + 40, len(text), 97)) + [len(text)]:
+        datalog_path.write_bytes(prefix + text[:cut])
+        merged_df = datalog.merge_datalog_incremental(test_seq_df, datalog_path, tmp_path, 'base', merged_path,
+                                                      chunksize=7)
+        whole_path.write_bytes(prefix + complete_lines(text, cut))
+        expected = merge_whole(test_seq_df, whole_path).assign(source=datalog_path.name)
+        pd.testing.assert_frame_equal(merged_df.reset_index(drop=True), expected, check_dtype=False)
+        expected.to_csv(whole_path, index=False)
+        assert merged_path.read_bytes() == whole_path.read_bytes()
+    assert datalog.load_checkpoint(tmp_path)[0]['offset'] == len(prefix + text)
+
+
+def test_appending_rows_keeps_other_tests(tmp_path):
+    test_seq_df = make_test_seq()
+    data_df = make_datalog().iloc[:-3]
+    datalog_path = tmp_path.joinpath('x-datalog.csv')
+    merged_path = tmp_path.joinpath('merged.csv')
+    datalog_path.write_bytes(data_df.to_csv(index=False).encode())
+    datalog.merge_datalog_incremental(test_seq_df, datalog_path, tmp_path, 'base', merged_path)
+    blocks_dir = datalog.store_paths(tmp_path)[2]
+    mtimes = {path.name: path.stat().st_mtime_ns for path in blocks_dir.iterdir()}
+
+    more_df = data_df.iloc[-3:].assign(Timestamp=data_df['Timestamp'].iloc[-1] + pd.to_timedelta([1, 2, 3], unit='s'))
+    with open(datalog_path, 'ab') as f:
+        f.write(more_df.to_csv(index=False, header=False).encode())
+    merged_df = datalog.merge_datalog_incremental(test_seq_df, datalog_path, tmp_path, 'base', merged_path)
+
+    assert datalog.load_checkpoint(tmp_path)[0]['appendable']
+    changed = {name for name, mtime in mtimes.items() if blocks_dir.joinpath(name).stat().st_mtime_ns != mtime}
+    assert changed == {datalog.block_path(blocks_dir, 6.0).name}
+    pd.testing.assert_frame_equal(merged_df, merge_whole(test_seq_df, datalog_path), check_dtype=False)
+
+
+def test_rewritten_datalog_is_read_again(tmp_path):
+    test_seq_df = make_test_seq()
+    data_df = make_datalog()
+    datalog_path = tmp_path.joinpath('x-datalog.csv')
+    merged_path = tmp_path.joinpath('merged.csv')
+    datalog_path.write_bytes(data_df.to_csv(index=False).encode())
+    datalog.merge_datalog_incremental(test_seq_df, datalog_path, tmp_path, 'base', merged_path)
+
+    data_df['Power'] += 1
+    datalog_path.write_bytes(data_df.to_csv(index=False).encode())
+    merged_df = datalog.merge_datalog_incremental(test_seq_df, datalog_path, tmp_path, 'base', merged_path)
+    pd.testing.assert_frame_equal(merged_df, merge_whole(test_seq_df, datalog_path), check_dtype=False)
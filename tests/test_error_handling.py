@@ -0,0 +1,30 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import PySimpleGUI as sg
+
+from core import error_handling
+
+
+def test_permission_popup_shown_on_main_thread(monkeypatch):
+    popup_threads = []
+    monkeypatch.setattr(sg, 'Popup', lambda msg: popup_threads.append(threading.current_thread()) or 'OK')
+    attempts = []
+
+    @error_handling.permission_popup
+    def write_file():
+        attempts.append(threading.current_thread())
+        if len(attempts) == 1:
+            raise PermissionError('merged.csv is open')
+        return 'written'
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(write_file)
+        while not future.done():
+            wait([future], timeout=.01)
+            error_handling.run_main_thread_calls()
+
+    assert future.result() == 'written'
+    assert popup_threads == [threading.main_thread()]
+    # the call is retried on the worker thread
+    assert attempts[1] is attempts[0] is not threading.main_thread()
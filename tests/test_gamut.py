@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from core.report import gamut
+
+BT709 = [[.64, .33], [.30, .60], [.15, .06]]
+BT2020 = [[.708, .292], [.170, .797], [.131, .046]]
+UNIT = [[0, 0], [1, 0], [0, 1]]
+
+
+@pytest.mark.parametrize('samples', [None, 200000])
+def test_coverage_regular_triangles(samples):
+    # BT.709 lies inside BT.2020, so it covers the ratio of their areas
+    assert gamut.triangle_coverage(BT709, BT2020, samples) == pytest.approx(.11205 / .2118665, abs=1e-2 if samples else 1e-12)
+    assert gamut.triangle_coverage(BT2020, BT709, samples) == pytest.approx(1, abs=1e-2 if samples else 1e-12)
+    # shifted by half: the intersection is a triangle with half the sides
+    assert gamut.triangle_coverage([[.5, 0], [1.5, 0], [.5, 1]], UNIT, samples) == \
+        pytest.approx(.25, abs=1e-2 if samples else 1e-12)
+    # vertex order doesn't matter
+    assert gamut.triangle_coverage(BT709[::-1], BT2020, samples) == gamut.triangle_coverage(BT709, BT2020, samples)
+
+
+@pytest.mark.parametrize('samples', [None, 1000])
+@pytest.mark.parametrize('primaries', [
+    [[.3, .3]] * 3,
+    [[.2, .2], [.3, .3], [.4, .4]],
+    [[.2, .2], [.2, .2], [.5, .4]],
+])
+def test_coverage_degenerate_primaries(primaries, samples):
+    assert gamut.triangle_coverage(primaries, BT2020, samples) == 0.0
+
+
+def test_polygon_area():
+    assert gamut.polygon_area(UNIT) == .5
+    assert gamut.polygon_area(np.array(BT709)) == pytest.approx(.11205, abs=1e-12)
@@ -0,0 +1,114 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from core.report import merge
+
+
+def make_datalog():
+    """Raw datalog rows with sub-second samples, stabilization, user command, camera ccf and null tags and a rewind."""
+    tags = (['1'] * 9 + [np.nan] * 2 + ['2'] * 7 + ['1'] * 8 + ['3 - stabilization 1'] * 5 + ['3.1 - user command'] * 3
+            + ['4 - camera ccf 1'] * 4 + ['4 - camera ccf 2'] * 4 + ['5'] * 6 + [np.nan] + ['5'] * 3 + ['2'] * 6)
+    rng = np.random.RandomState(0)
+    steps = rng.choice([.3, .5, 1, 1.2], len(tags))
+    return pd.DataFrame({
+        'Timestamp': pd.Timestamp('2020-05-01 12:00:00') + pd.to_timedelta(np.cumsum(steps), unit='s'),
+        'Power': rng.rand(len(tags)) * 100,
+        'Luminance': rng.rand(len(tags)) * 300,
+        'Tag': pd.Series(tags, dtype=object),
+    })
+
+
+def round_time_rowwise(dt, date_delta=datetime.timedelta(seconds=1)):
+    """The row-wise rounding quantize_time replaced, applied with Series.apply."""
+    roundTo = date_delta.total_seconds()
+    seconds = (dt.to_pydatetime() - dt.min).seconds
+    rounding = (seconds + roundTo / 2) // roundTo * roundTo
+    return dt + datetime.timedelta(0, rounding - seconds, -dt.microsecond)
+
+
+def remove_rows_rewind_loop(df, col='Tag'):
+    """The loop over rewound runs remove_rows_rewind replaced (expects a default index)."""
+    start_tag_seq_df = df[df[col] != df[col].shift(1)].dropna(subset=[col])
+    duplicate_start = start_tag_seq_df[start_tag_seq_df[col].duplicated(keep='last')].index.values
+    end_tag_seq_df = df[df[col] != df[col].shift(-1)].dropna(subset=[col])
+    duplicate_end = end_tag_seq_df[end_tag_seq_df[col].duplicated(keep='last')].index.values + 1
+    remove_rows = []
+    for start, end in zip(duplicate_start, duplicate_end):
+        remove_rows += range(start, end)
+    return df.drop(remove_rows)
+
+
+def reduce_whole(data_df):
+    """Whole-file reduction: camera ccf tags to tag numbers, rewinds removed, one row per second, clean tags."""
+    df = data_df.copy()
+    df['Tag'] = df['Tag'].map(lambda tag: tag[0] if 'camera ccf' in str(tag) else tag)
+    df = merge.remove_rows_rewind(df)
+    df['time'] = merge.quantize_time(df['Timestamp'])
+    df = df.drop_duplicates(subset=['time'])
+    df = df.dropna(subset=['Tag'])
+    df['Tag'] = df['Tag'].map(merge.clean_tag)
+    df = df.dropna(subset=['Tag'])
+    return df.reset_index(drop=True)[['time', 'Power', 'Luminance', 'Tag']]
+
+
+def reduce_chunks(data_df, chunksize):
+    reducer = merge.DatalogReducer()
+    for start in range(0, len(data_df), chunksize):
+        reducer.feed(data_df.iloc[start:start + chunksize])
+    return reducer
+
+
+@pytest.mark.parametrize('chunksize', [1, 7, 100, 1000])
+def test_reducer_chunksize_invariant(chunksize):
+    data_df = make_datalog()
+    reducer = reduce_chunks(data_df, chunksize)
+    expected = reduce_whole(data_df)
+    pd.testing.assert_frame_equal(reducer.result(), expected, check_dtype=False)
+    assert reducer.tag_counts == data_df['Tag'].value_counts().to_dict()
+
+
+def test_reducer_camera_ccf_tags():
+    data_df = make_datalog()
+    reduced = reduce_chunks(data_df, len(data_df)).result()
+    # both camera ccf runs are one run of tag 4, the rewound runs of tags 1 and 2 are discarded
+    assert 4.0 in set(reduced['Tag'])
+    assert not any('camera' in str(tag) for tag in reduced['Tag'])
+    assert list(pd.unique(reduced['Tag'])) == [1.0, 3.1, 4.0, 5.0, 2.0]
+
+
+def test_quantize_time_matches_round_time():
+    rng = np.random.RandomState(2)
+    # microsecond samples (as parsed from a datalog), exact half seconds and timestamps just before midnight
+    offsets = np.concatenate([rng.randint(0, 2 * 10 ** 11, 500), np.arange(0, 5 * 10 ** 6, 250000),
+                              86400 * 10 ** 6 - rng.randint(1, 10 ** 6, 20)])
+    timestamps = pd.Series(pd.Timestamp('2020-05-01 00:00:00') + pd.to_timedelta(offsets, unit='us'))
+    expected = timestamps.apply(round_time_rowwise)
+    pd.testing.assert_series_equal(merge.quantize_time(timestamps), expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_remove_rows_rewind_matches_loop(seed):
+    rng = np.random.RandomState(seed)
+    tags = pd.Series(rng.choice(['1', '2', '3', '4 - camera ccf 1', None], 300, p=[.3, .3, .2, .1, .1]), dtype=object)
+    df = pd.DataFrame({'Tag': np.repeat(tags.values, rng.randint(1, 6, len(tags))), 'Power': 0.0})
+    df['Power'] = np.arange(len(df), dtype=float)
+    pd.testing.assert_frame_equal(merge.remove_rows_rewind(df), remove_rows_rewind_loop(df))
+
+
+def test_remove_rows_rewind_matches_loop_on_merged():
+    data_df = make_datalog()
+    df = pd.DataFrame({'test_name': data_df['Tag'].map(lambda tag: f'test {tag}' if pd.notna(tag) else -1),
+                       'watts': data_df['Power']})
+    pd.testing.assert_frame_equal(merge.remove_rows_rewind(df, col='test_name'),
+                                  remove_rows_rewind_loop(df, col='test_name'))
+
+
+@pytest.mark.parametrize('dtype', [object, 'string'])
+def test_compact_merged_df_categories(dtype):
+    df = pd.DataFrame({'test_name': pd.Series(['a', 'a', 'b'], dtype=dtype), 'watts': [1.0, 2.0, 3.0]})
+    compact = merge.compact_merged_df(df)
+    assert isinstance(compact['test_name'].dtype, pd.CategoricalDtype)
+    assert compact['watts'].dtype == np.float32
@@ -0,0 +1,31 @@
+import matplotlib
+import matplotlib.pyplot as plt
+import pytest
+
+matplotlib.use('Agg')
+from core.report import render
+
+
+def line_plot(values):
+    fig, ax = plt.subplots(figsize=(2, 2))
+    ax.plot(values)
+    return fig
+
+
+def failing_plot(values):
+    raise ValueError('SVD did not converge')
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_failing_job_only_fails_its_figure(workers, monkeypatch):
+    monkeypatch.setattr(render, 'figure_cache', None)
+    jobs = [(line_plot, ([1, 2, 3],)), (failing_plot, ([1, 2],)), (line_plot, ([3, 2, 1],))]
+    pngs = render.render_pngs(jobs, workers=workers)
+    assert pngs[1] is None
+    assert all(png.startswith(b'\x89PNG') for png in [pngs[0], pngs[2]])
+
+
+def test_render_raises(monkeypatch):
+    monkeypatch.setattr(render, 'figure_cache', None)
+    with pytest.raises(ValueError):
+        render.render(failing_plot, [1, 2])
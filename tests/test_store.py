@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from core.report import cache, store
+
+
+def test_aggregate_matches_groupby():
+    rng = np.random.RandomState(0)
+    tags = np.repeat([3.0, 1.0, np.nan, 2.0, 3.1], [50, 30, 4, 5, 20])
+    watts = rng.rand(len(tags)) * 100
+    watts[rng.rand(len(tags)) < .2] = np.nan
+    merged_df = pd.DataFrame({
+        'tag': tags,
+        'test_name': pd.Series(tags).map({1.0: 'a', 2.0: 'b', 3.0: 'c', 3.1: 'standby'}),
+        'watts': watts,
+    })
+    merged_df.loc[0, 'test_name'] = np.nan
+    test_store = store.TestDataStore(merged_df)
+    stats = {'test_name': ('test_name', 'first'), 'watts last 10': ('watts', 'tail_mean')}
+    stats.update({f'watts {stat}': ('watts', stat) for stat in ['count', 'sum', 'mean', 'min', 'max', 'std']})
+    result = test_store.aggregate(stats, tail=10)
+
+    by_tag = merged_df.groupby('tag')
+    expected = pd.DataFrame({
+        'test_name': by_tag['test_name'].first(),
+        'watts last 10': by_tag['watts'].apply(lambda s: s.tail(10).mean()),
+        **{f'watts {stat}': by_tag['watts'].agg(stat) for stat in ['count', 'sum', 'mean', 'min', 'max', 'std']},
+    })
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_subset_key_only_covers_its_tests():
+    merged_df = pd.DataFrame({
+        'tag': [1.0, 1.0, 2.0, 2.0, 3.0],
+        'test_name': ['stabilization1', 'stabilization1', 'stabilization2', 'stabilization2', 'default'],
+        'watts': [1.0, 2.0, 3.0, 4.0, 5.0],
+    })
+    test_store = store.TestDataStore(merged_df)
+    subset = test_store.subset(['stabilization1', 'stabilization2'])
+    assert subset.test_names == ['stabilization1', 'stabilization2']
+    pd.testing.assert_frame_equal(subset.test('stabilization2'), test_store.test('stabilization2'))
+
+    # rows appended to another test don't change the key of a figure drawing the subset
+    more_df = pd.concat([merged_df, pd.DataFrame({'tag': [3.0], 'test_name': ['default'], 'watts': [6.0]})])
+    more_subset = store.TestDataStore(more_df).subset(['stabilization1', 'stabilization2'])
+    assert cache.hash_objects(subset) == cache.hash_objects(more_subset)
+    assert cache.hash_objects(test_store) != cache.hash_objects(store.TestDataStore(more_df))